@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+""" Throughput benchmarks for the EmailQueue pipeline.
+
+    Measures EmailQueue.prepare_email render throughput (django and, when installed, jinja2
+    engines), EmailQueue.queue_email inserts per second and emailqueue_send messages per second
+    against a throwaway test database using test_settings.py and the locmem email backend
+    (or a local SMTP stub via --smtp).
+
+    Results are written as JSON so they can be compared between releases:
+
+        python benchmarks.py
+        python benchmarks.py --sizes 1000 10000 --output bench.json
+        python benchmarks.py --smtp localhost:1025     # e.g. python -m aiosmtpd -n -l localhost:1025
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+DEFAULT_ATTACHMENT_SIZES = [100, 1000]
+
+NEWSLETTER_SUBJECT = 'Weekly digest for {{ user.name }}'
+NEWSLETTER_BODY = """
+<html><body>
+<h1>Hello {{ user.name }},</h1>
+<p>Here is what happened on {{ domain }} this week.</p>
+<table>
+{% for item in items %}
+    <tr class="{% cycle 'odd' 'even' %}">
+        <td>{{ forloop.counter }}</td>
+        <td><a href="https://{{ domain }}/items/{{ item.id }}/">{{ item.title }}</a></td>
+        <td>{{ item.summary }}</td>
+        <td>{% if item.price %}${{ item.price }}{% else %}Free{% endif %}</td>
+    </tr>
+{% endfor %}
+</table>
+<p>You are receiving this because you subscribed at {{ domain }}.</p>
+</body></html>
+"""
+
+JINJA2_NEWSLETTER_SUBJECT = NEWSLETTER_SUBJECT
+JINJA2_NEWSLETTER_BODY = """
+<html><body>
+<h1>Hello {{ user.name }},</h1>
+<p>Here is what happened on {{ domain }} this week.</p>
+<table>
+{% for item in items %}
+    <tr class="{{ loop.cycle('odd', 'even') }}">
+        <td>{{ loop.index }}</td>
+        <td><a href="https://{{ domain }}/items/{{ item.id }}/">{{ item.title }}</a></td>
+        <td>{{ item.summary }}</td>
+        <td>{% if item.price %}${{ item.price }}{% else %}Free{% endif %}</td>
+    </tr>
+{% endfor %}
+</table>
+<p>You are receiving this because you subscribed at {{ domain }}.</p>
+</body></html>
+"""
+
+
+def jinja2_installed():
+    try:
+        import jinja2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def newsletter_contexts(items=25):
+    return {
+        'user': {'name': 'Benchmark User'},
+        'domain': 'example.com',
+        'items': [
+            {'id': i, 'title': f'Item number {i}', 'summary': 'Lorem ipsum dolor sit amet. ' * 4, 'price': i % 3}
+            for i in range(items)
+        ],
+    }
+
+
+class Benchmarks(object):
+
+    def __init__(self, attachment_kb=256, attachments_per_email=3):
+        from django.core import mail
+        from django_templated_emailer.models import EmailTemplate
+
+        self.mail = mail
+        self.attachment_kb = attachment_kb
+        self.attachments_per_email = attachments_per_email
+
+        self.template = EmailTemplate.objects.create(
+            name='Benchmark Newsletter',
+            subject=NEWSLETTER_SUBJECT,
+            body=NEWSLETTER_BODY,
+            render_engine='django',
+        )
+        self.jinja2_template = EmailTemplate.objects.create(
+            name='Benchmark Newsletter Jinja2',
+            subject=JINJA2_NEWSLETTER_SUBJECT,
+            body=JINJA2_NEWSLETTER_BODY,
+            render_engine='jinja2',
+        )
+        self.contexts = newsletter_contexts()
+
+        self.attachment_folder = tempfile.mkdtemp(prefix='dte-bench-')
+        self.attachment_paths = []
+        for i in range(attachments_per_email):
+            path = os.path.join(self.attachment_folder, f'attachment-{i}.bin')
+            with open(path, 'wb') as fo:
+                fo.write(os.urandom(attachment_kb * 1024))
+            self.attachment_paths.append(path)
+
+    def cleanup(self):
+        shutil.rmtree(self.attachment_folder, ignore_errors=True)
+
+    def _reset(self):
+        from django_templated_emailer.models import EmailQueue
+        EmailQueue.objects.all().delete()
+        if hasattr(self.mail, 'outbox'):
+            self.mail.outbox = []
+
+    @staticmethod
+    def _result(name, rows, seconds, **extra):
+        result = {
+            'benchmark': name,
+            'rows': rows,
+            'seconds': round(seconds, 6),
+            'per_second': round(rows / seconds, 2) if seconds else None,
+        }
+        result.update(extra)
+        return result
+
+    def _backlog(self, rows, attachments=''):
+        """ Inserts rows already rendered so only the sender is measured. """
+        from django_templated_emailer.models import EmailQueue
+
+        eq = EmailQueue.prepare_email(template_name=self.template, send_to='someone@example.com', **self.contexts)
+        EmailQueue.objects.bulk_create([
+            EmailQueue(
+                template_name=eq.template_name,
+                send_to=f'user{i}@example.com',
+                subject=eq.subject,
+                body=eq.body,
+                attachments=attachments,
+            )
+            for i in range(rows)
+        ], batch_size=1000)
+
+    def prepare_email(self, rows, engine='django'):
+        from django_templated_emailer.models import EmailQueue
+
+        template = self.jinja2_template if engine == 'jinja2' else self.template
+        start = time.perf_counter()
+        for i in range(rows):
+            EmailQueue.prepare_email(template_name=template, send_to=f'user{i}@example.com', **self.contexts)
+        return self._result('prepare_email', rows, time.perf_counter() - start, engine=engine)
+
+    def prepare_email_jinja2(self, rows):
+        return self.prepare_email(rows, engine='jinja2')
+
+    def queue_email(self, rows):
+        from django_templated_emailer.models import EmailQueue
+
+        self._reset()
+        start = time.perf_counter()
+        for i in range(rows):
+            EmailQueue.queue_email(template_name=self.template, send_to=f'user{i}@example.com', **self.contexts)
+        return self._result('queue_email', rows, time.perf_counter() - start)
+
+    def emailqueue_send(self, rows):
+        from django.core.management import call_command
+
+        self._reset()
+        self._backlog(rows)
+        start = time.perf_counter()
+        call_command('emailqueue_send')
+        return self._result('emailqueue_send', rows, time.perf_counter() - start)
+
+    def emailqueue_send_attachments(self, rows):
+        from django.core.management import call_command
+
+        self._reset()
+        self._backlog(rows, attachments=','.join(self.attachment_paths))
+        start = time.perf_counter()
+        call_command('emailqueue_send')
+        return self._result(
+            'emailqueue_send_attachments', rows, time.perf_counter() - start,
+            attachments_per_email=self.attachments_per_email,
+            attachment_kb=self.attachment_kb,
+        )
+
+
+def run(sizes, attachment_sizes, attachment_kb=256, attachments_per_email=3, log=None):
+    """ Runs every benchmark and returns a list of result dicts. """
+    bench = Benchmarks(attachment_kb=attachment_kb, attachments_per_email=attachments_per_email)
+    results = []
+    try:
+        names = ['prepare_email', 'queue_email', 'emailqueue_send']
+        if jinja2_installed():
+            names.insert(1, 'prepare_email_jinja2')
+
+        for name in names:
+            for rows in sizes:
+                results.append(getattr(bench, name)(rows))
+                if log:
+                    log(results[-1])
+
+        for rows in attachment_sizes:
+            results.append(bench.emailqueue_send_attachments(rows))
+            if log:
+                log(results[-1])
+    finally:
+        bench.cleanup()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='django_templated_emailer throughput benchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Backlog sizes to run each benchmark with.')
+    parser.add_argument('--attachment-sizes', type=int, nargs='*', default=DEFAULT_ATTACHMENT_SIZES,
+                        help='Backlog sizes for the attachment heavy send benchmark.')
+    parser.add_argument('--attachment-kb', type=int, default=256)
+    parser.add_argument('--attachments-per-email', type=int, default=3)
+    parser.add_argument('--smtp', help='host:port of a local SMTP stub to send through instead of locmem.')
+    parser.add_argument('--output', help='File to write the JSON results to, defaults to stdout.')
+    options = parser.parse_args(argv)
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'test_settings')
+
+    import django
+    django.setup()
+
+    from django.conf import settings
+    from django.db import connection
+    from django.test.utils import setup_test_environment, teardown_test_environment
+
+    setup_test_environment()
+    if options.smtp:
+        host, _, port = options.smtp.partition(':')
+        settings.EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+        settings.EMAIL_HOST = host
+        settings.EMAIL_PORT = int(port or 25)
+    email_backend = settings.EMAIL_BACKEND
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        results = run(
+            sizes=options.sizes,
+            attachment_sizes=options.attachment_sizes,
+            attachment_kb=options.attachment_kb,
+            attachments_per_email=options.attachments_per_email,
+            log=lambda r: print(json.dumps(r), file=sys.stderr),
+        )
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    output = {
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'email_backend': email_backend,
+        'results': results,
+    }
+
+    if options.output:
+        with open(options.output, 'w') as fo:
+            json.dump(output, fo, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+
+if __name__ == '__main__':
+    main()
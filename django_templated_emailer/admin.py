@@ -1,21 +1,75 @@
 from django.contrib import admin, messages
+from django.core.exceptions import ImproperlyConfigured
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
 
 from .app_settings import app_settings
 from .models import EmailTemplate, EmailQueue
 
 
+def estimate_count(model, using='default'):
+    """ Returns the databases row estimate for model's table, None when it can't be estimated. """
+    connection = connections[using]
+    table = model._meta.db_table
+
+    if connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples::bigint FROM pg_class WHERE oid = to_regclass(%s)'
+    elif connection.vendor == 'mysql':
+        sql = 'SELECT TABLE_ROWS FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s'
+    else:
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [table])
+        row = cursor.fetchone()
+
+    # PostgreSQL reports -1 for tables that were never analyzed.
+    if not row or row[0] is None or row[0] < 0:
+        return None
+    return row[0]
+
+
+class EstimatedCountPaginator(Paginator):
+    """ Uses the database's row estimate instead of COUNT(*) for unfiltered changelists of large tables. """
+
+    @cached_property
+    def count(self):
+        query = getattr(self.object_list, 'query', None)
+        if query is not None and not query.where:
+            estimate = estimate_count(self.object_list.model, using=self.object_list.db)
+            if estimate is not None and estimate >= app_settings.ADMIN_ESTIMATED_COUNT_THRESHOLD:
+                return estimate
+        return super().count
+
+
+# search_fields entry per ADMIN_SEARCH_MODE. prefix and exact are case sensitive lookups, the admin's
+# ^ and = compile to UPPER(col) LIKE UPPER(term) on PostgreSQL which no plain index can serve.
+SEARCH_MODE_FIELDS = {
+    'contains': '{}',
+    'prefix': '{}__startswith',
+    'exact': '{}__exact',
+    'fulltext': '@{}',
+}
+
+
 @admin.register(EmailTemplate)
 class EmailTemplateAdmin(admin.ModelAdmin):
 
     list_display = ('name', 'send_tos', 'subject', 'default')
     ordering = ('name',)
+    list_filter = ('default',)
+    show_full_result_count = False
 
     fieldsets = (
         (None, {
             'fields': ('name', 'send_to', 'cc_to', 'bcc_to', 'send_to_switch_true', 'send_to_switch_false')
         }),
+        ('Schedule', {
+            'fields': ('send_after_minutes', 'digest_minutes', ('send_window_start', 'send_window_end'))
+        }),
         ('Email', {
-            'fields': ('subject', 'body', 'available_contexts', 'default')
+            'fields': ('subject', 'body', 'render_engine', 'available_contexts', 'default')
         })
     )
 
@@ -58,21 +112,31 @@ class EmailTemplateAdmin(admin.ModelAdmin):
 
 
 def requeue_email_queue(modeladmin, request, queryset):
-    for item in queryset:
-        item.pk = None
-        item.sent = False
-        item.date_sent = None
-        item.save()
+    count = queryset.requeue()
+    modeladmin.message_user(request, f'{count} emails queued again.', messages.SUCCESS)
 requeue_email_queue.short_description = 'ReQueue Selected Emails.'
 
 
+def cancel_email_queue(modeladmin, request, queryset):
+    count = queryset.cancel(user=request.user)
+    modeladmin.message_user(request, f'{count} unsent emails cancelled.', messages.SUCCESS)
+cancel_email_queue.short_description = 'Cancel Selected Unsent Emails.'
+
+
 @admin.register(EmailQueue)
 class EmailQueueAdmin(admin.ModelAdmin):
-    list_display = ('subject', 'send_at_this_time', 'sent', 'send_tos')
+    list_display = ('subject', 'send_at_this_time', 'sent', 'send_tos', 'sent_by')
+    list_select_related = ('sent_by',)
+    list_filter = ('sent',)
+    date_hierarchy = 'inserted'
+
+    actions = [requeue_email_queue, cancel_email_queue]
 
-    actions = [requeue_email_queue]
+    # Backed by the -date_sent, -id index, the admin adds -pk itself to make the ordering total.
+    ordering = ['-date_sent', '-id']
 
-    ordering = ['-date_sent']
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
     # readonly_fields = ('updated', 'inserted', 'sent', 'date_sent')
     readonly_fields = ('updated', 'inserted')
@@ -81,7 +145,7 @@ class EmailQueueAdmin(admin.ModelAdmin):
 
     fieldsets = (
         (None, {
-            'fields': ('template_name', 'send_to', 'reply_to', 'cc_to', 'bcc_to', ('sent', 'date_sent'), ('model_one_name', 'model_one_id'), ('model_two_name', 'model_two_id'))
+            'fields': ('template_name', 'send_to', 'reply_to', 'cc_to', 'bcc_to', ('send_at', 'send_timezone'), ('sent', 'date_sent'), ('model_one_name', 'model_one_id'), ('model_two_name', 'model_two_id'))
         }),
         ('Email', {
             'fields': ('subject', 'body', 'attachments')
@@ -91,6 +155,12 @@ class EmailQueueAdmin(admin.ModelAdmin):
         })
     )
 
+    def get_search_fields(self, request):
+        mode = app_settings.ADMIN_SEARCH_MODE
+        if mode not in SEARCH_MODE_FIELDS:
+            raise ImproperlyConfigured(f'Unknown TEMPLATED_EMAILER_ADMIN_SEARCH_MODE "{mode}", use one of {list(SEARCH_MODE_FIELDS)}')
+        return [SEARCH_MODE_FIELDS[mode].format(field) for field in self.search_fields]
+
     def send_at_this_time(self, obj):
         return obj.send_at_this_time()
 
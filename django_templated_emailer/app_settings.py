@@ -70,4 +70,147 @@ class AppSettings(object):
             GLOBAL_CONTEXTS = GLOBAL_CONTEXTS()
         return GLOBAL_CONTEXTS
 
+    @property
+    def LINK_CONTENT_TYPES(self):
+        # Also link model_one/model_two through ContentType and an integer id, which search_for then uses.
+        # Emails queued before turning this on only have the model name and id strings, which are still matched.
+        return self._setting('LINK_CONTENT_TYPES', False)
+
+    @property
+    def RENDER_ENGINE(self):
+        # Template language used for subject and body, 'django' or 'jinja2'. EmailTemplate.render_engine overrides it.
+        return self._setting('RENDER_ENGINE', 'django')
+
+    @property
+    def JINJA2_BYTECODE_CACHE_DIR(self):
+        # Directory jinja2 keeps compiled templates in between processes, None to only cache in memory.
+        return self._setting('JINJA2_BYTECODE_CACHE_DIR', None)
+
+    @property
+    def JINJA2_CACHE_SIZE(self):
+        # Compiled jinja2 templates kept in memory per process.
+        return self._setting('JINJA2_CACHE_SIZE', 400)
+
+    @property
+    def JINJA2_AUTOESCAPE(self):
+        # HTML escape variables like the django engine does.
+        return self._setting('JINJA2_AUTOESCAPE', True)
+
+    @property
+    def PLAIN_TEXT_FROM_HTML(self):
+        # Convert the HTML body to plain text for the text/plain part, False sends the HTML as is in both parts.
+        return self._setting('PLAIN_TEXT_FROM_HTML', True)
+
+    @property
+    def PRECOMPUTE_TEXT_BODY(self):
+        # Convert to plain text in prepare_email and store it on EmailQueue.text_body instead of when sending.
+        return self._setting('PRECOMPUTE_TEXT_BODY', False)
+
+    @property
+    def TEXT_BODY_CACHE_SIZE(self):
+        # How many distinct bodies keep their plain text conversion cached, per process.
+        return self._setting('TEXT_BODY_CACHE_SIZE', 256)
+
+    @property
+    def DIGEST_SUBJECT(self):
+        # Subject of a digest email, formatted with subject (of the oldest email), count and others.
+        return self._setting('DIGEST_SUBJECT', '{subject} (+{others} more)')
+
+    @property
+    def DIGEST_SEPARATOR(self):
+        # Placed between each emails body in a digest email.
+        return self._setting('DIGEST_SEPARATOR', '<hr>')
+
+    @property
+    def SENDER_CHUNK_SIZE(self):
+        # Rows emailqueue_send reads per database round trip, and the most it holds in memory at once.
+        return self._setting('SENDER_CHUNK_SIZE', 500)
+
+    @property
+    def BULK_BATCH_SIZE(self):
+        # emailqueue_send sends up to this many emails with identical subject, body and attachments
+        # (and no cc, bcc or reply to) as one SMTP transaction. 1 sends every email on its own.
+        return self._setting('BULK_BATCH_SIZE', 1)
+
+    @property
+    def BULK_BATCH_TO_HEADER(self):
+        # To header of batched emails, the recipients are only in the SMTP envelope.
+        return self._setting('BULK_BATCH_TO_HEADER', 'undisclosed-recipients:;')
+
+    @property
+    def NOTIFY_CHANNEL(self):
+        # PostgreSQL channel queue_email NOTIFYs and emailqueue_send --daemon LISTENs on, None to disable.
+        return self._setting('NOTIFY_CHANNEL', 'django_templated_emailer')
+
+    @property
+    def DAEMON_POLL_INTERVAL(self):
+        # Longest emailqueue_send --daemon sleeps before checking the queue again, in seconds.
+        return self._setting('DAEMON_POLL_INTERVAL', 30)
+
+    @property
+    def SHARD_LEASE_SECONDS(self):
+        # How long an emailqueue_send --shards node keeps its shards without a heartbeat.
+        # Must be longer than it takes to send a single email.
+        return self._setting('SHARD_LEASE_SECONDS', 60)
+
+    @property
+    def ADMIN_SEARCH_MODE(self):
+        # How the EmailQueue admin searches send_to and subject: 'contains' (LIKE '%term%', can't use an index),
+        # 'prefix' (LIKE 'term%'), 'exact' (both case sensitive on PostgreSQL so they can use an index)
+        # or 'fulltext' (PostgreSQL full text search, needs django.contrib.postgres).
+        return self._setting('ADMIN_SEARCH_MODE', 'contains')
+
+    @property
+    def ADMIN_ESTIMATED_COUNT_THRESHOLD(self):
+        # Unfiltered admin changelists of tables estimated at this many rows or more show the estimate instead of COUNT(*).
+        # Only PostgreSQL and MySQL provide an estimate.
+        return self._setting('ADMIN_ESTIMATED_COUNT_THRESHOLD', 100000)
+
+    @property
+    def METRICS_BACKEND(self):
+        # Dot notation path to a metrics.BaseMetrics subclass receiving send pipeline timings and counters.
+        return self._setting('METRICS_BACKEND', 'django_templated_emailer.metrics.BaseMetrics')
+
+    @property
+    def PROMETHEUS_TEXTFILE(self):
+        # Where PrometheusMetrics.flush() writes its output, for the node_exporter textfile collector.
+        return self._setting('PROMETHEUS_TEXTFILE', None)
+
+    @property
+    def STATSD_HOST(self):
+        return self._setting('STATSD_HOST', 'localhost')
+
+    @property
+    def STATSD_PORT(self):
+        return self._setting('STATSD_PORT', 8125)
+
+    @property
+    def STATSD_PREFIX(self):
+        return self._setting('STATSD_PREFIX', 'django_templated_emailer')
+
+    @property
+    def SINK_BUFFER_SIZE(self):
+        # Messages backends.SinkEmailBackend keeps in memory, older messages are dropped.
+        return self._setting('SINK_BUFFER_SIZE', 1000)
+
+    @property
+    def SINK_MBOX_PATH(self):
+        # Also append every message SinkEmailBackend accepts to this mbox file.
+        return self._setting('SINK_MBOX_PATH', None)
+
+    @property
+    def SINK_MBOX_MAX_BYTES(self):
+        # Size at which the sink mbox is rotated to SINK_MBOX_PATH + '.1', replacing the previous one.
+        return self._setting('SINK_MBOX_MAX_BYTES', 64 * 1024 * 1024)
+
+    @property
+    def SINK_LATENCY(self):
+        # Seconds SinkEmailBackend sleeps per message, to imitate a remote SMTP server.
+        return self._setting('SINK_LATENCY', 0)
+
+    @property
+    def SINK_ERROR_RATE(self):
+        # Fraction (0 to 1) of messages SinkEmailBackend rejects with an SMTP 451 error.
+        return self._setting('SINK_ERROR_RATE', 0)
+
 app_settings = AppSettings('TEMPLATED_EMAILER_')
@@ -0,0 +1,74 @@
+import collections
+import os
+import random
+import re
+import smtplib
+import threading
+import time
+from email.utils import parseaddr
+
+from django.core.mail.backends.base import BaseEmailBackend
+
+from .app_settings import app_settings
+
+outbox = collections.deque(maxlen=app_settings.SINK_BUFFER_SIZE)
+stats = collections.Counter()
+
+_lock = threading.Lock()
+_from_line = re.compile(rb'^From ', re.MULTILINE)
+
+
+def reset():
+    """ Empties the sink outbox and counters, resizing the outbox to SINK_BUFFER_SIZE. """
+    global outbox
+    with _lock:
+        outbox = collections.deque(maxlen=app_settings.SINK_BUFFER_SIZE)
+        stats.clear()
+
+
+class SinkEmailBackend(BaseEmailBackend):
+    """ Accepts messages without any network for load testing emailqueue_send.
+
+    Every message is serialized as it would be for SMTP, then kept in a bounded in-memory buffer
+    (backends.outbox) and optionally appended to a rotating mbox file. SINK_LATENCY and
+    SINK_ERROR_RATE imitate a slow or failing server.
+    """
+
+    def __init__(self, fail_silently=False, latency=None, error_rate=None, mbox_path=None, **kwargs):
+        super().__init__(fail_silently=fail_silently, **kwargs)
+        self.latency = app_settings.SINK_LATENCY if latency is None else latency
+        self.error_rate = app_settings.SINK_ERROR_RATE if error_rate is None else error_rate
+        self.mbox_path = mbox_path or app_settings.SINK_MBOX_PATH
+        self.random = random.Random()
+
+    def send_messages(self, email_messages):
+        sent = 0
+        for message in email_messages:
+            if self.latency:
+                time.sleep(self.latency)
+
+            if self.error_rate and self.random.random() < self.error_rate:
+                with _lock:
+                    stats['failed'] += 1
+                if not self.fail_silently:
+                    raise smtplib.SMTPResponseException(451, b'Sink injected failure')
+                continue
+
+            data = message.message().as_bytes(linesep='\n')
+            with _lock:
+                outbox.append(data)
+                stats['sent'] += 1
+                if self.mbox_path:
+                    self.write_mbox(message.from_email, data)
+            sent += 1
+
+        return sent
+
+    def write_mbox(self, from_email, data):
+        if os.path.exists(self.mbox_path) and os.path.getsize(self.mbox_path) >= app_settings.SINK_MBOX_MAX_BYTES:
+            os.replace(self.mbox_path, self.mbox_path + '.1')
+
+        with open(self.mbox_path, 'ab') as f:
+            f.write(f'From {parseaddr(from_email or "")[1] or "MAILER-DAEMON"} {time.asctime()}\n'.encode())
+            f.write(_from_line.sub(b'>From ', data))
+            f.write(b'\n\n')
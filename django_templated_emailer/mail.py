@@ -0,0 +1,49 @@
+import copy
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives
+from django.core.mail.utils import DNS_NAME
+from email.utils import formatdate, make_msgid
+
+
+class PreparedEmailMessage(EmailMultiAlternatives):
+    """ Sends an already built MIME message with this messages recipients and headers.
+
+    The subject, body and attachment parts of prepared (already base64 encoded) are shared
+    between every copy, only the To, Cc, Reply-To, Date and Message-ID headers are replaced.
+
+    Args:
+        prepared: MIME message returned by EmailMessage.message() with identical subject, body and attachments.
+    """
+
+    REPLACED_HEADERS = ('To', 'Cc', 'Reply-To', 'Date', 'Message-ID')
+
+    def __init__(self, prepared, **kwargs):
+        super().__init__(**kwargs)
+        self.prepared = prepared
+        self.from_email = kwargs.get('from_email') or prepared['From']
+
+    def message(self, *args, **kwargs):
+        # A shallow copy shares the encoded payload, deleting a header rebinds the copies header list.
+        msg = copy.copy(self.prepared)
+        for name in self.REPLACED_HEADERS:
+            del msg[name]
+
+        header_names = {key.lower() for key in self.extra_headers}
+        if self.to and 'to' not in header_names:
+            msg['To'] = ', '.join(str(v) for v in self.to)
+        if self.cc:
+            msg['Cc'] = ', '.join(str(v) for v in self.cc)
+        if self.reply_to and 'reply-to' not in header_names:
+            msg['Reply-To'] = ', '.join(str(v) for v in self.reply_to)
+        if 'date' not in header_names:
+            msg['Date'] = formatdate(localtime=settings.EMAIL_USE_LOCALTIME)
+        if 'message-id' not in header_names:
+            msg['Message-ID'] = make_msgid(domain=DNS_NAME)
+
+        for name, value in self.extra_headers.items():
+            if name.lower() != 'from':
+                del msg[name]
+                msg[name] = value
+
+        return msg
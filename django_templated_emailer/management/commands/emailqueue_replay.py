@@ -0,0 +1,122 @@
+import json
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers import deserialize
+from django.db import connections
+from django.db.models import Max
+
+from ... import backends
+from ...models import EmailQueue
+from . import emailqueue_send
+
+SINK_BACKEND = 'django_templated_emailer.backends.SinkEmailBackend'
+
+
+class Command(BaseCommand):
+    help = 'Queues the emails in an EmailQueue export again, optionally sending them to the sink backend and reporting throughput'
+
+    def add_arguments(self, parser):
+        parser.add_argument('export', help='JSON file from: manage.py dumpdata django_templated_emailer.EmailQueue')
+        parser.add_argument('--repeat', type=int, default=1, help='Queue every exported email this many times.')
+        parser.add_argument('--keep-schedule', action='store_true',
+                            help='Keep send_at, send_after_minutes and digest_minutes instead of making every email due now.')
+        parser.add_argument('--no-attachments', action='store_true', help='Drop attachments that may not exist on this machine.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per INSERT.')
+        parser.add_argument('--send', action='store_true', help='Run emailqueue_send on the replayed emails and report throughput.')
+        parser.add_argument('--backend', default=SINK_BACKEND, help='Email backend used by --send.')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Concurrent emailqueue_send runs, each with its own --shard of --shards WORKERS.')
+        parser.add_argument('--output', help='Write the JSON report to this file instead of stdout.')
+
+    def load(self, path, repeat, keep_schedule, no_attachments):
+        try:
+            with open(path) as f:
+                objects = [o.object for o in deserialize('json', f, ignorenonexistent=True) if isinstance(o.object, EmailQueue)]
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Could not read {path}: {e}')
+
+        fields = [f.attname for f in EmailQueue._meta.concrete_fields]
+        emails = []
+        for email in [EmailQueue(**{f: getattr(o, f) for f in fields}) for _ in range(repeat) for o in objects]:
+            email.pk = None
+            email.sent = False
+            email.fake_sent = False
+            email.date_sent = None
+            # Users and content types in the export don't exist in this database.
+            for field in EmailQueue._meta.concrete_fields:
+                if field.is_relation:
+                    setattr(email, field.attname, None)
+            if not keep_schedule:
+                email.send_at = None
+                email.send_after_minutes = None
+                email.digest_minutes = None
+            if no_attachments:
+                email.attachments = ''
+            emails.append(email)
+
+        return emails
+
+    def send(self, queryset, backend, workers):
+        """ Runs emailqueue_send over queryset only, split into workers shards on as many threads. """
+        def run(shard):
+            command = emailqueue_send.Command()
+            command.backend = backend
+            command.queryset = queryset
+            if workers > 1:
+                command.total_shards, command.shards = workers, [shard]
+            try:
+                command.send_queued()
+            finally:
+                if workers > 1:
+                    connections.close_all()
+
+        if workers == 1:
+            return run(0)
+
+        threads = [threading.Thread(target=run, args=(shard,)) for shard in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def handle(self, *args, **kwargs):
+        if kwargs['repeat'] < 1 or kwargs['workers'] < 1:
+            raise CommandError('--repeat and --workers must be at least 1')
+
+        emails = self.load(kwargs['export'], kwargs['repeat'], kwargs['keep_schedule'], kwargs['no_attachments'])
+        last_pk = EmailQueue.objects.aggregate(Max('pk'))['pk__max'] or 0
+
+        start = time.perf_counter()
+        EmailQueue.objects.bulk_create(emails, batch_size=kwargs['batch_size'])
+        report = {
+            'queued': len(emails),
+            'queue_seconds': time.perf_counter() - start,
+        }
+
+        if kwargs['send']:
+            # Only the replayed emails are sent, anything already queued is left alone.
+            replayed = EmailQueue.objects.filter(pk__gt=last_pk)
+            backends.reset()
+            start = time.perf_counter()
+            self.send(replayed, kwargs['backend'], kwargs['workers'])
+            seconds = time.perf_counter() - start
+
+            sent = replayed.filter(sent=True).count()
+            report.update({
+                'backend': kwargs['backend'],
+                'workers': kwargs['workers'],
+                'sent': sent,
+                'unsent': replayed.filter(sent=False).count(),
+                'send_seconds': seconds,
+                'per_second': sent / seconds if seconds else None,
+                'sink': dict(backends.stats) if kwargs['backend'] == SINK_BACKEND else None,
+            })
+
+        output = json.dumps(report, indent=2)
+        if kwargs['output']:
+            with open(kwargs['output'], 'w') as f:
+                f.write(output)
+        else:
+            self.stdout.write(output)
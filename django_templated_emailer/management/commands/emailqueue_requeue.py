@@ -0,0 +1,60 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+
+from ...models import EmailQueue
+
+
+class Command(BaseCommand):
+    help = 'Queues selected emails again, or cancels them with --cancel, in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--cancel', action='store_true', help='Cancel the selected unsent emails instead of requeueing them.')
+        parser.add_argument('--all', action='store_true', help='Select every email, required when no other selector is given.')
+        parser.add_argument('--ids', type=int, nargs='+', help='EmailQueue ids to select.')
+        parser.add_argument('--template', help='Select emails with this template_name.')
+        parser.add_argument('--sent', action='store_true', default=None, help='Only select sent emails.')
+        parser.add_argument('--unsent', action='store_false', dest='sent', help='Only select unsent emails.')
+        parser.add_argument('--inserted-after', help='Select emails inserted at or after this ISO datetime.')
+        parser.add_argument('--inserted-before', help='Select emails inserted before this ISO datetime.')
+        parser.add_argument('--user', help='Username of the user cancelling the emails.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Rows per INSERT or UPDATE.')
+
+    def parse_datetime(self, value, option):
+        parsed = parse_datetime(value)
+        if not parsed:
+            raise CommandError(f'{option} must be an ISO datetime, got "{value}"')
+        return parsed
+
+    def handle(self, *args, **kwargs):
+        selectors = ('ids', 'template', 'inserted_after', 'inserted_before')
+        if not kwargs['all'] and kwargs['sent'] is None and not any(kwargs[s] for s in selectors):
+            raise CommandError('Select emails with --ids, --template, --sent, --unsent, --inserted-after or '
+                               '--inserted-before, or pass --all to select every email.')
+
+        queryset = EmailQueue.objects.all()
+
+        if kwargs['ids']:
+            queryset = queryset.filter(pk__in=kwargs['ids'])
+        if kwargs['template']:
+            queryset = queryset.filter(template_name=kwargs['template'])
+        if kwargs['sent'] is not None:
+            queryset = queryset.filter(sent=kwargs['sent'])
+        if kwargs['inserted_after']:
+            queryset = queryset.filter(inserted__gte=self.parse_datetime(kwargs['inserted_after'], '--inserted-after'))
+        if kwargs['inserted_before']:
+            queryset = queryset.filter(inserted__lt=self.parse_datetime(kwargs['inserted_before'], '--inserted-before'))
+
+        if kwargs['cancel']:
+            user = None
+            if kwargs['user']:
+                try:
+                    user = get_user_model().objects.get_by_natural_key(kwargs['user'])
+                except get_user_model().DoesNotExist:
+                    raise CommandError(f'No user "{kwargs["user"]}" found')
+
+            count = queryset.cancel(user=user, batch_size=kwargs['batch_size'])
+            self.stdout.write(f'{count} emails cancelled.')
+        else:
+            count = queryset.requeue(batch_size=kwargs['batch_size'])
+            self.stdout.write(f'{count} emails queued again.')
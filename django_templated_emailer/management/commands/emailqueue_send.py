@@ -1,8 +1,18 @@
 import logging
+import signal
+import time
 
-from django.core.management.base import BaseCommand
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.db.models import Count, Min, Q
+from django.utils import timezone
 
+from ...app_settings import app_settings
+from ...metrics import get_metrics
 from ...models import EmailQueue
+from ...sharding import ShardLeases, default_node_name, filter_shards
+from ...wakeup import get_waker
 
 log = logging.getLogger('django_templated_emailer.emailqueue_send')
 
@@ -10,10 +20,203 @@ log = logging.getLogger('django_templated_emailer.emailqueue_send')
 class Command(BaseCommand):
     help = 'Sends all emails queued'
 
+    running = True
+    # Email backend path and EmailQueue queryset to send from, emailqueue_replay narrows both.
+    backend = None
+    queryset = None
+    leases = None
+    shards = None
+    total_shards = None
+
+    def add_arguments(self, parser):
+        parser.add_argument('--daemon', action='store_true',
+                            help='Stay resident, sleeping until the next email is due or queue_email sends a NOTIFY.')
+        parser.add_argument('--poll-interval', type=float, default=app_settings.DAEMON_POLL_INTERVAL,
+                            help='Longest the daemon sleeps between checking the queue, in seconds.')
+        parser.add_argument('--shards', type=int,
+                            help='Split EmailQueue into this many shards by id. Without --shard, shards are '
+                                 'shared between running nodes through heartbeated leases.')
+        parser.add_argument('--shard', type=int, help='Only send emails in this shard (0 to --shards - 1).')
+        parser.add_argument('--node', default=None, help='Name of this node for shard leases, defaults to hostname:pid.')
+
     def handle(self, *args, **kwargs):
+        self.total_shards = kwargs.get('shards')
+
+        if kwargs.get('shard') is not None:
+            if not self.total_shards or not 0 <= kwargs['shard'] < self.total_shards:
+                raise CommandError('--shard must be between 0 and --shards - 1')
+            self.shards = [kwargs['shard']]
+
+        elif self.total_shards:
+            self.leases = ShardLeases(kwargs.get('node') or default_node_name(), self.total_shards)
+
+        try:
+            if kwargs.get('daemon'):
+                return self.run_daemon(kwargs['poll_interval'])
+
+            self.heartbeat()
+            self.send_queued()
+        finally:
+            get_metrics().flush()
+            if self.leases:
+                self.leases.release()
+
+    def heartbeat(self):
+        """ Renews shard leases, updating the shards this node sends. """
+        self.last_heartbeat = time.monotonic()
+        if self.leases:
+            self.shards = self.leases.heartbeat()
+
+    def owns(self, email):
+        """ Whether email is in one of this nodes shards, shards can be handed over mid run. """
+        return not self.total_shards or email.pk % self.total_shards in self.shards
+
+    def get_queryset(self):
+        queryset = (self.queryset if self.queryset is not None else EmailQueue.objects).filter(sent=False)
+        if self.total_shards:
+            queryset = filter_shards(queryset, self.shards, self.total_shards)
+        return queryset
+
+    def due_chunks(self):
+        """ Yields lists of due EmailQueue pks, streaming only the columns needed to decide. """
+        chunk_size = app_settings.SENDER_CHUNK_SIZE
+        now = timezone.now()
+        chunk = []
+
+        queryset = self.get_queryset().exclude(send_at__gt=now).only(*EmailQueue.DUE_FIELDS).order_by('pk')
+        for email in queryset.iterator(chunk_size=chunk_size):
+            if email.is_due(now):
+                chunk.append(email.pk)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+    def keep_sending(self):
+        """ False once the daemon is stopping, heartbeats while sending a long backlog. """
+        if not self.running:
+            return False
+        if self.leases and time.monotonic() - self.last_heartbeat > self.leases.ttl.total_seconds() / 3:
+            self.heartbeat()
+        return True
+
+    def send_queued(self):
+        """ Sends every email that is due over a single email backend connection.
+
+        Full rows, bodies included, are only loaded a chunk at a time for emails about to be sent.
+        Emails in a chunk with identical subject, body and attachments share one MIME message,
+        and with BULK_BATCH_SIZE above 1, share SMTP transactions.
+        """
+        metrics = get_metrics()
+
+        if self.total_shards and not self.shards:
+            return
 
-        for email in EmailQueue.objects.filter(sent=False):
+        backlog = self.get_queryset().aggregate(depth=Count('pk'), oldest=Min('inserted'))
+        metrics.gauge('queue.depth', backlog['depth'])
+        metrics.gauge('queue.oldest_unsent_age', (timezone.now() - backlog['oldest']).total_seconds() if backlog['oldest'] else 0)
+
+        connection = mail.get_connection(self.backend)
+        try:
+            for chunk in self.due_chunks():
+                if self.total_shards and not self.shards:
+                    return
+                emails = EmailQueue.objects.filter(pk__in=chunk, sent=False).order_by('pk')
+                for group in EmailQueue.group_identical(emails):
+                    if not self.send_group(group, connection):
+                        return
+        finally:
+            connection.close()
+
+    def send_group(self, group, connection):
+        """ Sends emails sharing a payload, returns False if sending should stop. """
+        prepared = None
+        if len(group) > 1:
+            try:
+                prepared = group[0].build_message().message()
+            except:
+                log.exception(f'Building shared message for {group[0]} failed, building each email instead.')
+
+        batch_size = app_settings.BULK_BATCH_SIZE
+        if prepared is not None and batch_size > 1:
+            batchable = [e for e in group if e.is_batchable()]
+            group = [e for e in group if not e.is_batchable()]
+
+            for i in range(0, len(batchable), batch_size):
+                if not self.keep_sending():
+                    return False
+                batch = [e for e in batchable[i:i + batch_size] if self.owns(e)]
+                if not batch:
+                    continue
+                try:
+                    connection.open()
+                    EmailQueue.send_batch(batch, prepared, connection=connection)
+                except:
+                    log.exception(f'Batch of {len(batch)} starting with {batch[0]}')
+                    # Reconnect for the next email in case the connection is what failed.
+                    connection.close()
+
+        for email in group:
+            if not self.keep_sending():
+                return False
+            if not self.owns(email):
+                continue
             try:
-                email.send()
+                connection.open()
+                email.send(connection=connection, prepared=prepared, within=self.get_queryset())
             except:
                 log.exception(str(email))
+                # Reconnect for the next email in case the connection is what failed.
+                connection.close()
+
+        return True
+
+    def seconds_until_next(self, poll_interval):
+        if self.leases:
+            poll_interval = min(poll_interval, self.leases.ttl.total_seconds() / 3)
+        now = timezone.now()
+        queryset = self.get_queryset()
+        next_due = [queryset.filter(send_at__gt=now).aggregate(Min('send_at'))['send_at__min']]
+
+        # send_after_minutes and digest_minutes would need per database date arithmetic, check a
+        # bounded number of the oldest delayed emails instead, the poll interval covers the rest.
+        delayed = queryset.filter(Q(send_at__isnull=True, send_after_minutes__gt=0) | Q(digest_minutes__gt=0))
+        for email in delayed.only(*EmailQueue.DUE_FIELDS).order_by('inserted')[:app_settings.SENDER_CHUNK_SIZE]:
+            due = email.due_at()
+            if due > now:
+                next_due.append(due)
+
+        next_due = [due for due in next_due if due]
+        if not next_due:
+            return poll_interval
+        return min(poll_interval, (min(next_due) - now).total_seconds())
+
+    def stop(self, signum, frame):
+        log.info(f'Received signal {signum}, stopping after the email in progress.')
+        self.running = False
+        self.waker.wake()
+
+    def run_daemon(self, poll_interval):
+        self.waker = get_waker()
+        previous_handlers = {sig: signal.signal(sig, self.stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+
+        try:
+            while self.running:
+                close_old_connections()
+                try:
+                    self.heartbeat()
+                    self.send_queued()
+                    get_metrics().flush()
+                    timeout = self.seconds_until_next(poll_interval)
+                except Exception:
+                    log.exception('emailqueue_send daemon iteration failed')
+                    timeout = poll_interval
+
+                if self.running:
+                    self.waker.wait(timeout)
+        finally:
+            for sig, handler in previous_handlers.items():
+                signal.signal(sig, handler)
+            self.waker.close()
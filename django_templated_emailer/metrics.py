@@ -0,0 +1,166 @@
+import contextlib
+import os
+import re
+import socket
+import threading
+import time
+
+from django.utils.module_loading import import_string
+
+from .app_settings import app_settings
+
+_backends = {}
+
+
+def get_metrics():
+    """ Returns the metrics backend configured by TEMPLATED_EMAILER_METRICS_BACKEND.
+
+    One instance is kept per backend path so counters accumulate for the life of the process.
+    """
+    path = app_settings.METRICS_BACKEND
+    if path not in _backends:
+        _backends[path] = import_string(path)()
+    return _backends[path]
+
+
+class BaseMetrics(object):
+    """ No-op metrics backend used by default.
+
+    Subclass and override increment, gauge and timing to push the send pipeline numbers elsewhere.
+    Names are dotted (send.smtp, queue.depth), tags are passed through as keyword arguments.
+    """
+
+    def increment(self, name, value=1, **tags):
+        pass
+
+    def gauge(self, name, value, **tags):
+        pass
+
+    def timing(self, name, seconds, **tags):
+        pass
+
+    def flush(self):
+        pass
+
+    def reset(self):
+        """ Forgets everything recorded so far. """
+        pass
+
+    @contextlib.contextmanager
+    def timer(self, name, **tags):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, time.perf_counter() - start, **tags)
+
+
+class PrometheusMetrics(BaseMetrics):
+    """ Keeps metrics in memory and renders them in the Prometheus text exposition format.
+
+    When TEMPLATED_EMAILER_PROMETHEUS_TEXTFILE is set, flush() writes the output there
+    for the node_exporter textfile collector, which suits one-shot emailqueue_send runs.
+    """
+
+    def __init__(self, namespace='django_templated_emailer'):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.timings = {}
+
+    @staticmethod
+    def _key(name, tags):
+        return name, tuple(sorted((k, str(v)) for k, v in tags.items()))
+
+    def increment(self, name, value=1, **tags):
+        key = self._key(name, tags)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **tags):
+        with self.lock:
+            self.gauges[self._key(name, tags)] = value
+
+    def timing(self, name, seconds, **tags):
+        key = self._key(name, tags)
+        with self.lock:
+            total, count = self.timings.get(key, (0.0, 0))
+            self.timings[key] = (total + seconds, count + 1)
+
+    def _metric_name(self, name, suffix=''):
+        return re.sub(r'[^a-zA-Z0-9_]', '_', f'{self.namespace}_{name}{suffix}')
+
+    @staticmethod
+    def _labels(tags):
+        if not tags:
+            return ''
+        labels = ','.join('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in tags)
+        return '{' + labels + '}'
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for values, mtype, suffix in [(self.counters, 'counter', '_total'), (self.gauges, 'gauge', '')]:
+                seen = set()
+                for (name, tags), value in sorted(values.items()):
+                    metric = self._metric_name(name, suffix)
+                    if metric not in seen:
+                        lines.append(f'# TYPE {metric} {mtype}')
+                        seen.add(metric)
+                    lines.append(f'{metric}{self._labels(tags)} {value}')
+
+            seen = set()
+            for (name, tags), (total, count) in sorted(self.timings.items()):
+                metric = self._metric_name(name, '_seconds')
+                if metric not in seen:
+                    lines.append(f'# TYPE {metric} summary')
+                    seen.add(metric)
+                lines.append(f'{metric}_sum{self._labels(tags)} {total}')
+                lines.append(f'{metric}_count{self._labels(tags)} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        path = app_settings.PROMETHEUS_TEXTFILE
+        if not path:
+            return
+        # Write then rename so the collector never reads a half written file.
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as fo:
+            fo.write(self.render())
+        os.replace(tmp_path, path)
+
+
+class StatsdMetrics(BaseMetrics):
+    """ Fire and forget statsd over UDP, tags are appended to the metric name. """
+
+    def __init__(self):
+        self.address = (app_settings.STATSD_HOST, app_settings.STATSD_PORT)
+        self.prefix = app_settings.STATSD_PREFIX
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def _name(self, name, tags):
+        parts = [self.prefix, name] + [re.sub(r'[^a-zA-Z0-9_-]', '_', str(v)) for _, v in sorted(tags.items())]
+        return '.'.join(p for p in parts if p)
+
+    def _send(self, data):
+        try:
+            self.socket.sendto(data.encode('utf-8'), self.address)
+        except OSError:
+            pass
+
+    def increment(self, name, value=1, **tags):
+        self._send(f'{self._name(name, tags)}:{value}|c')
+
+    def gauge(self, name, value, **tags):
+        self._send(f'{self._name(name, tags)}:{value}|g')
+
+    def timing(self, name, seconds, **tags):
+        self._send(f'{self._name(name, tags)}:{seconds * 1000:.3f}|ms')
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_templated_emailer', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailqueue',
+            name='send_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailqueue',
+            name='send_timezone',
+            field=models.CharField(blank=True, help_text='Recipients timezone used for send windows.', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='emailtemplate',
+            name='send_window_end',
+            field=models.TimeField(blank=True, help_text='Time of day, in the recipients timezone, after which this email waits for the next window. Set it before the start to wrap midnight.', null=True),
+        ),
+        migrations.AddField(
+            model_name='emailtemplate',
+            name='send_window_start',
+            field=models.TimeField(blank=True, help_text='Earliest time of day, in the recipients timezone, this email may be sent.', null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_templated_emailer', '0002_send_at_and_windows'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailqueue',
+            name='digest_minutes',
+            field=models.IntegerField(blank=True, help_text='Hold unsent emails to the same recipient and linked model for this many minutes and send them as one email.', null=True),
+        ),
+        migrations.AddField(
+            model_name='emailtemplate',
+            name='digest_minutes',
+            field=models.IntegerField(blank=True, help_text='Hold unsent emails to the same recipient and linked model for this many minutes and send them as one email.', null=True),
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:51
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_key(*parts):
+    # Copy of utils.hash_key when this migration was written, so later changes don't alter it.
+    return hashlib.sha256('\x1f'.join(str(p) if p is not None else '' for p in parts).encode('utf-8')).hexdigest()
+
+
+def backfill_dedup_key(apps, schema_editor):
+    # Only unsent emails can be replaced by delete_unsent_matching, leave the sent history alone.
+    EmailQueue = apps.get_model('django_templated_emailer', 'EmailQueue')
+
+    fields = ['template_name', 'subject', 'send_to', 'model_one_name', 'model_one_id', 'model_two_name', 'model_two_id']
+    batch = []
+    for eq in EmailQueue.objects.filter(sent=False).only('pk', *fields).iterator(chunk_size=1000):
+        eq.dedup_key = hash_key(*[getattr(eq, f) for f in fields])
+        batch.append(eq)
+        if len(batch) >= 1000:
+            EmailQueue.objects.bulk_update(batch, ['dedup_key'])
+            batch = []
+    if batch:
+        EmailQueue.objects.bulk_update(batch, ['dedup_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_templated_emailer', '0003_digest_minutes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailqueue',
+            name='dedup_key',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.RunPython(backfill_dedup_key, migrations.RunPython.noop),
+    ]
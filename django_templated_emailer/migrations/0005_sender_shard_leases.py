@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_templated_emailer', '0004_emailqueue_dedup_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SenderLease',
+            fields=[
+                ('shard', models.IntegerField(primary_key=True, serialize=False)),
+                ('owner', models.CharField(blank=True, max_length=255)),
+                ('expires', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name': 'Sender Lease',
+            },
+        ),
+        migrations.CreateModel(
+            name='SenderNode',
+            fields=[
+                ('name', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('expires', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name': 'Sender Node',
+            },
+        ),
+    ]
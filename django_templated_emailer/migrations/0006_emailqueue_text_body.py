@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_templated_emailer', '0005_sender_shard_leases'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailqueue',
+            name='text_body',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 11:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_templated_emailer', '0006_emailqueue_text_body'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailtemplate',
+            name='render_engine',
+            field=models.CharField(blank=True, choices=[('django', 'Django'), ('jinja2', 'Jinja2')], help_text='Template language of the subject and body, blank uses the TEMPLATED_EMAILER_RENDER_ENGINE setting.', max_length=20),
+        ),
+    ]
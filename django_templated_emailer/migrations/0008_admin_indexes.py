@@ -0,0 +1,36 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:00
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_templated_emailer', '0007_emailtemplate_render_engine'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='emailtemplate',
+            name='name',
+            field=models.CharField(db_index=True, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='emailqueue',
+            index=models.Index(fields=['-date_sent', '-id'], name='dte_emailqueue_date_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emailqueue',
+            index=models.Index(fields=['sent', 'inserted'], name='dte_emailqueue_sent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emailqueue',
+            index=models.Index(fields=['inserted'], name='dte_emailqueue_inserted_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emailqueue',
+            index=models.Index(fields=['subject'], name='dte_emailqueue_subject_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('django_templated_emailer', '0008_admin_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='emailqueue',
+            name='model_one_object_id',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailqueue',
+            name='model_one_type',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='contenttypes.contenttype'),
+        ),
+        migrations.AddField(
+            model_name='emailqueue',
+            name='model_two_object_id',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='emailqueue',
+            name='model_two_type',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='contenttypes.contenttype'),
+        ),
+        migrations.AddIndex(
+            model_name='emailqueue',
+            index=models.Index(fields=['model_one_type', 'model_one_object_id'], name='dte_emailqueue_model_one_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='emailqueue',
+            index=models.Index(fields=['model_two_type', 'model_two_object_id'], name='dte_emailqueue_model_two_idx'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-19 12:13
+
+from django.conf import settings
+from django.db import migrations, models
+
+SEND_TO_INDEX = 'dte_emailqueue_send_to_idx'
+
+
+def create_send_to_index(apps, schema_editor):
+    # send_to is a TextField: PostgreSQL needs text_pattern_ops for LIKE 'term%', MySQL a prefix length.
+    quote = schema_editor.quote_name
+    table = quote(apps.get_model('django_templated_emailer', 'EmailQueue')._meta.db_table)
+    column = {
+        'postgresql': f'{quote("send_to")} text_pattern_ops',
+        'mysql': f'{quote("send_to")}(255)',
+        'sqlite': quote('send_to'),
+    }.get(schema_editor.connection.vendor)
+    if column:
+        schema_editor.execute(f'CREATE INDEX {quote(SEND_TO_INDEX)} ON {table} ({column})')
+
+
+def drop_send_to_index(apps, schema_editor):
+    quote = schema_editor.quote_name
+    table = quote(apps.get_model('django_templated_emailer', 'EmailQueue')._meta.db_table)
+    vendor = schema_editor.connection.vendor
+    if vendor == 'mysql':
+        schema_editor.execute(f'DROP INDEX {quote(SEND_TO_INDEX)} ON {table}')
+    elif vendor in ('postgresql', 'sqlite'):
+        schema_editor.execute(f'DROP INDEX {quote(SEND_TO_INDEX)}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('django_templated_emailer', '0009_emailqueue_content_type_links'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='emailqueue',
+            name='dte_emailqueue_subject_idx',
+        ),
+        migrations.AddIndex(
+            model_name='emailqueue',
+            index=models.Index(fields=['subject'], name='dte_emailqueue_subject_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.RunPython(create_send_to_index, drop_send_to_index),
+    ]
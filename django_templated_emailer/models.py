@@ -4,16 +4,22 @@ import tempfile
 import datetime
 import logging
 import shutil
+import time
 
 from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
 from django.core.mail import EmailMultiAlternatives
-from django.db import models
-from django.template import Template, Context
+from django.db import models, transaction
+from django.db.models.functions import Concat, Left
 from django.utils import timezone
 from django.conf import settings as django_settings
 
-from . import utils
+from . import rendering, scheduler, signals, utils
 from .app_settings import app_settings
+from .mail import PreparedEmailMessage
+from .metrics import get_metrics
+from .wakeup import notify_sender
 
 logger = logging.getLogger('django_templated_emailer')
 
@@ -28,6 +34,8 @@ class BaseEmailFields(models.Model):
     bcc_to = models.TextField(null=True, blank=True)
 
     send_after_minutes = models.IntegerField(null=True, blank=True)
+    digest_minutes = models.IntegerField(null=True, blank=True, help_text='Hold unsent emails to the same recipient and '
+                                                                          'linked model for this many minutes and send them as one email.')
 
     subject = models.CharField(max_length=500)
 
@@ -45,7 +53,7 @@ class EmailTemplate(BaseEmailFields):
 
     admin_list_help = """Emails wrapped in ( ) are conditional Send To type"""
 
-    name = models.CharField(max_length=255)
+    name = models.CharField(max_length=255, db_index=True)
     body = app_settings.TEMPLATE_BODY_FIELD_TYPE(**app_settings.TEMPLATE_BODY_FIELD_PARAMS)
 
     send_to_switch_true = models.CharField(max_length=500, blank=True, help_text='Email Address to add to the Send To field when the switch statement is True')
@@ -55,6 +63,13 @@ class EmailTemplate(BaseEmailFields):
 
     default = models.BooleanField(default=False)
 
+    render_engine = models.CharField(max_length=20, blank=True, choices=rendering.ENGINE_CHOICES,
+                                     help_text='Template language of the subject and body, blank uses the TEMPLATED_EMAILER_RENDER_ENGINE setting.')
+
+    send_window_start = models.TimeField(null=True, blank=True, help_text='Earliest time of day, in the recipients timezone, this email may be sent.')
+    send_window_end = models.TimeField(null=True, blank=True, help_text='Time of day, in the recipients timezone, after which this email waits for the next window. '
+                                                                      'Set it before the start to wrap midnight.')
+
     def save(self, *args, **kwargs):
 
         if app_settings.TEMPLATE_DEFAULT_ALLOW_CHANGING_NAME and self.pk and self.default:
@@ -85,6 +100,78 @@ class EmailTemplate(BaseEmailFields):
             return cls.objects.filter(name=name).order_by('-updated').first()
 
 
+class EmailQueueQuerySet(models.QuerySet):
+
+    # Not copied by requeue, the rest of the row is.
+    REQUEUE_EXCLUDED_FIELDS = ('id', 'sent', 'date_sent', 'inserted', 'updated')
+
+    def _pk_chunks(self, batch_size, *fields):
+        """ Yields lists of values dicts (pk included) walking the queryset by pk, without holding a cursor open. """
+        last_pk = None
+        while True:
+            chunk = self.order_by('pk')
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            chunk = list(chunk.values('pk', *fields)[:batch_size])
+            if not chunk:
+                return
+            yield chunk
+            last_pk = chunk[-1]['pk']
+
+    def requeue(self, batch_size=1000):
+        """ Queues a new unsent copy of every email, batch_size rows per INSERT.
+
+        Returns:
+            int: number of emails queued.
+        """
+        fields = [f.attname for f in self.model._meta.concrete_fields if f.attname not in self.REQUEUE_EXCLUDED_FIELDS]
+
+        # Bound by the current highest pk so the copies are never picked up again.
+        max_pk = self.aggregate(models.Max('pk'))['pk__max']
+        if max_pk is None:
+            return 0
+
+        count = 0
+        for chunk in self.filter(pk__lte=max_pk)._pk_chunks(batch_size, *fields):
+            self.model.objects.bulk_create([
+                self.model(**{k: v for k, v in values.items() if k != 'pk'}) for values in chunk
+            ])
+            count += len(chunk)
+
+        if count:
+            notify_sender(using=self.db)
+        return count
+
+    def cancel(self, user=None, batch_size=None):
+        """ Marks every unsent email as fake sent, noting who cancelled it in template_name.
+
+        Args:
+            user: User cancelling the emails.
+            batch_size: Rows per UPDATE, None updates everything in one statement.
+
+        Returns:
+            int: number of emails cancelled.
+        """
+        now = timezone.now()
+        suffix = ' - Undo by {} on {}'.format(getattr(user, 'email', None) or 'system', now.strftime('%Y-%m-%d %H:%M:%S'))
+        values = {
+            'template_name': Left(Concat('template_name', models.Value(suffix)), 255),
+            'sent': True,
+            'date_sent': now,
+            'fake_sent': True,
+            'updated': now,
+        }
+
+        unsent = self.filter(sent=False)
+        if not batch_size:
+            return unsent.update(**values)
+
+        count = 0
+        for chunk in unsent._pk_chunks(batch_size):
+            count += self.model.objects.filter(pk__in=[v['pk'] for v in chunk], sent=False).update(**values)
+        return count
+
+
 class EmailQueue(BaseEmailFields):
     """ Storage for emails ready to be sent.
 
@@ -98,18 +185,52 @@ class EmailQueue(BaseEmailFields):
 
     class Meta:
         verbose_name = 'Email Queue'
+        indexes = [
+            # Admin changelist ordering
+            models.Index(fields=['-date_sent', '-id'], name='dte_emailqueue_date_sent_idx'),
+            # Admin date hierarchy, sent filter and the senders backlog queries
+            models.Index(fields=['sent', 'inserted'], name='dte_emailqueue_sent_idx'),
+            models.Index(fields=['inserted'], name='dte_emailqueue_inserted_idx'),
+            # Admin prefix/exact search, PostgreSQL needs the pattern opclass for LIKE 'term%'.
+            # Other databases ignore opclasses. send_to is a TextField, migration 0010 indexes it per database.
+            models.Index(fields=['subject'], name='dte_emailqueue_subject_idx', opclasses=['varchar_pattern_ops']),
+            # search_for, QueuedEmails and prefetch_for lookups
+            models.Index(fields=['model_one_type', 'model_one_object_id'], name='dte_emailqueue_model_one_idx'),
+            models.Index(fields=['model_two_type', 'model_two_object_id'], name='dte_emailqueue_model_two_idx'),
+        ]
+
+    objects = EmailQueueQuerySet.as_manager()
 
     # What module within django is sending this? Just for tracking purposes.
     template_name = models.CharField(max_length=255, blank=True)
 
     body = app_settings.QUEUE_BODY_FIELD_TYPE(**app_settings.QUEUE_BODY_FIELD_PARAMS)
 
+    # Plain text alternative of body, filled in by prepare_email when PRECOMPUTE_TEXT_BODY is on.
+    text_body = models.TextField(blank=True)
+
     # A Way to link the email to a specific item
     model_one_name = models.CharField(max_length=255, blank=True)
     model_one_id = models.CharField(max_length=255, blank=True)
     model_two_name = models.CharField(max_length=255, null=True, blank=True)
     model_two_id = models.CharField(max_length=255, null=True, blank=True)
 
+    # Indexed ContentType linkage filled alongside the names when LINK_CONTENT_TYPES is on
+    # and the linked model has an integer primary key.
+    model_one_type = models.ForeignKey(ContentType, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    model_one_object_id = models.PositiveBigIntegerField(null=True, blank=True)
+    model_one_object = GenericForeignKey('model_one_type', 'model_one_object_id')
+    model_two_type = models.ForeignKey(ContentType, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    model_two_object_id = models.PositiveBigIntegerField(null=True, blank=True)
+    model_two_object = GenericForeignKey('model_two_type', 'model_two_object_id')
+
+    # Hash of the fields delete_unsent_matching compares, see get_dedup_key
+    dedup_key = models.CharField(max_length=64, blank=True, db_index=True)
+
+    # Absolute time to send at, takes precedence over send_after_minutes.
+    send_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    send_timezone = models.CharField(max_length=64, blank=True, help_text='Recipients timezone used for send windows.')
+
     sent = models.BooleanField(default=False)
     date_sent = models.DateTimeField(null=True, blank=True)
     fake_sent = models.BooleanField(default=False)
@@ -123,7 +244,8 @@ class EmailQueue(BaseEmailFields):
     def prepare_email(template_name=None, attachments=None, send_to=None,
                       send_after_minutes=None, model_one=None, model_two=None, subject=None, body=None,
                       sent_by=None, reply_to=None, cc_to=None, bcc_to=None, send_to_switch=None,
-                      override_template_name=None, override_subject=None, override_body=None, **contexts):
+                      override_template_name=None, override_subject=None, override_body=None,
+                      send_at=None, send_timezone=None, **contexts):
         """ Prepares an EmailQueue object for sending without Saving or Sending it.
 
             Useful when we want to quickly template out an EmailTemplate object for use in a custom form.
@@ -146,6 +268,8 @@ class EmailQueue(BaseEmailFields):
             override_template_name: Changes the template_name value saved to the database
             override_subject: Force the subject to this value instead of what is set in the template
             override_body: Force the body to this value instead of what is set in the template
+            send_at: Absolute datetime to send the email at, overrides send_after_minutes.
+            send_timezone: Recipients timezone name, the template send window is applied in this timezone.
             **contexts: All keyword items to add to the EmailTemplate subject and body rendering.
 
         Returns:
@@ -153,14 +277,17 @@ class EmailQueue(BaseEmailFields):
         """
 
         eq = EmailQueue()
+        metrics = get_metrics()
 
         if isinstance(template_name, EmailTemplate):
             template = template_name
             template_name = template_name.name
 
         elif template_name:
-            template = EmailTemplate.get_template(name=template_name)
+            with metrics.timer('prepare.template_lookup'):
+                template = EmailTemplate.get_template(name=template_name)
             if not template:
+                metrics.increment('prepare.template_missing')
                 return
 
         else:
@@ -204,6 +331,15 @@ class EmailQueue(BaseEmailFields):
         except (TypeError, ValueError):
             eq.send_after_minutes = template.send_after_minutes
 
+        eq.digest_minutes = template.digest_minutes
+
+        eq.send_at = send_at
+        eq.send_timezone = send_timezone or ''
+
+        if template.send_window_start and template.send_window_end:
+            when = send_at or timezone.now() + datetime.timedelta(minutes=eq.send_after_minutes or 0)
+            eq.send_at = scheduler.next_in_window(when, template.send_window_start, template.send_window_end, send_timezone)
+
         eq.template_name = template_name
         eq.body = template.body
         eq.subject = template.subject
@@ -229,8 +365,14 @@ class EmailQueue(BaseEmailFields):
         if callable(eq.body):
             eq.body = eq.body(eq, **combined_contexts)
 
-        eq.subject = Template(eq.subject).render(context=Context(combined_contexts))
-        eq.body = Template(eq.body).render(context=Context(combined_contexts))
+        engine = template.render_engine or app_settings.RENDER_ENGINE
+        with metrics.timer('prepare.render', engine=engine):
+            eq.subject = rendering.render(eq.subject, combined_contexts, engine=engine)
+            eq.body = rendering.render(eq.body, combined_contexts, engine=engine)
+
+        eq.dedup_key = eq.get_dedup_key()
+
+        eq.text_body = eq.precompute_text_body()
 
         return eq
 
@@ -245,7 +387,8 @@ class EmailQueue(BaseEmailFields):
             fake_sent (bool): relic from tryout system. Idea was to show the
                                 end-user as being sent but not actually sent.
             delete_unsent_matching: If you're re-queueing an email, supply exact same details and any
-                                        unsent where subject, send_to, and template_name match are deleted.
+                                        unsent where subject, send_to, template_name and linked models
+                                        match are replaced by this one.
             *args: See prepare_email
             **kwargs: See prepare_email
 
@@ -271,81 +414,303 @@ class EmailQueue(BaseEmailFields):
             eq.fake_sent = True
 
         if delete_unsent_matching and eq.template_name:
+            eq.replace_unsent_matching()
+        else:
+            eq.save()
 
-            eqs = EmailQueue.objects.filter(
-                sent=False,
-                subject=eq.subject,
-                send_to=eq.send_to,
-                template_name=eq.template_name
-            )
+        if not eq.sent:
+            notify_sender()
 
-            if eq.model_one_name:
-                eqs = eqs.filter(model_one_name=eq.model_one_name, model_one_id=eq.model_one_id)
-            if eq.model_two_name:
-                eqs = eqs.filter(model_two_name=eq.model_two_name, model_two_id=eq.model_two_id)
+        return eq
 
-            eqs.delete()
+    def get_dedup_key(self):
+        return utils.hash_key(
+            self.template_name,
+            self.subject,
+            self.send_to,
+            self.model_one_name,
+            self.model_one_id,
+            self.model_two_name,
+            self.model_two_id,
+        )
 
-        eq.save()
+    def replace_unsent_matching(self):
+        """ Saves this email, then deletes the other unsent emails with the same dedup_key.
 
-        return eq
+        The INSERT and the indexed DELETE run in one transaction, so a failure leaves the old
+        email in place. Two concurrent callers can both insert and each delete only what it sees,
+        so both replacements can survive. The replacement is always a new row, emailqueue_send
+        doesn't lock rows and a sender that already loaded the old row would save it back as sent.
+        """
+        self.dedup_key = self.get_dedup_key()
 
-    def send(self, send_immediately=False):
+        with transaction.atomic():
+            self.save()
+            EmailQueue.objects.filter(sent=False, dedup_key=self.dedup_key).exclude(pk=self.pk).delete()
+
+    def send(self, send_immediately=False, connection=None, prepared=None, within=None):
+        """ Sends the email once it is due.
+
+        Args:
+            send_immediately: Ignore send_at, send_after_minutes and digest_minutes.
+            connection: Email backend connection to send through, useful to reuse one for many emails.
+            prepared: MIME message from build_message().message() of an email with the same subject, body
+                      and attachments. It is reused with this emails recipients instead of being built again.
+            within: EmailQueue queryset digest emails are collected from, emailqueue_send passes its shards.
+
+        Returns:
+            bool: Whether the email was sent.
+        """
 
         if self.sent:
             return True
 
-        if self.send_after_minutes and not send_immediately:
+        if not send_immediately and not self.is_due():
+            return False
+
+        digest = []
+        if self.digest_minutes and self.pk and not send_immediately:
+
+            # Another email in the same digest may have already sent this one.
+            if not EmailQueue.objects.filter(pk=self.pk, sent=False).exists():
+                self.sent = True
+                return True
+
+            digest = list(self.get_digest_queryset(within=within))
+
+        metrics = get_metrics()
+        start = time.perf_counter()
+
+        subject, body, attachments = self.subject, self.body, self.attachments
+        if digest:
+            emails = sorted([self] + digest, key=lambda e: (e.inserted, e.pk))
+            subject = app_settings.DIGEST_SUBJECT.format(subject=emails[0].subject, count=len(emails), others=len(digest))
+            body = app_settings.DIGEST_SEPARATOR.join(e.body for e in emails)
+            # Template attachments are on every email, attach (and download) each once.
+            attachments = ','.join(dict.fromkeys(a for e in emails for a in e.attachments.split(',') if a))
+
+        if prepared is not None and not digest:
+            email_message = PreparedEmailMessage(
+                prepared,
+                connection=connection,
+                to=utils.unique_emails(self.send_to),
+                reply_to=utils.unique_emails(self.reply_to),
+                cc=utils.unique_emails(self.cc_to),
+                bcc=utils.unique_emails(self.bcc_to),
+            )
+            metrics.increment('send.prepared_reused')
+        else:
+            email_message = self.build_message(connection=connection, subject=subject, body=body, attachments=attachments)
+
+        try:
+            with metrics.timer('send.smtp'):
+                email_message.send()
+            self.sent = True
+            self.date_sent = timezone.now()
+            with metrics.timer('send.save'):
+                self.save()
+                if digest:
+                    EmailQueue.objects.filter(pk__in=[e.pk for e in digest]).update(sent=True, date_sent=self.date_sent)
+        except Exception as e:
+            metrics.increment('send.failed', error=e.__class__.__name__)
+            signals.email_send_failed.send(sender=EmailQueue, instance=self, exception=e)
+            raise
+
+        seconds = time.perf_counter() - start
+        metrics.increment('send.sent')
+        if digest:
+            metrics.increment('send.digest_coalesced', len(digest))
+        metrics.timing('send.total', seconds)
+        if self.inserted:
+            metrics.timing('send.latency', max((self.date_sent - self.send_at_this_time()).total_seconds(), 0))
+        signals.email_sent.send(sender=EmailQueue, instance=self, seconds=seconds)
+
+        return self.sent
+
+    def build_message(self, connection=None, subject=None, body=None, attachments=None):
+        """ Builds the EmailMultiAlternatives for this email, downloading and attaching any attachments.
 
-            if self.send_at_this_time() > timezone.now():
-                return False
+        subject, body and attachments default to this emails values.
+        """
+        metrics = get_metrics()
+
+        subject = self.subject if subject is None else subject
+        body = self.body if body is None else body
+        attachments = self.attachments if attachments is None else attachments
 
         email_message = EmailMultiAlternatives(
+            connection=connection,
             to=utils.unique_emails(self.send_to),
             reply_to=utils.unique_emails(self.reply_to),
             cc=utils.unique_emails(self.cc_to),
             bcc=utils.unique_emails(self.bcc_to),
-            subject=self.subject,
-            body=self.body,
+            subject=subject,
+            body=self.get_text_body(body),
         )
-        email_message.attach_alternative(self.body, 'text/html')
+        email_message.attach_alternative(body, 'text/html')
+
+        if attachments:
+            attachments_start = time.perf_counter()
+            temp_folder = None
+
+            try:
+                for attachment in attachments.split(','):
+
+                    if attachment.startswith('http') or attachment.startswith('www'):
+
+                        if not temp_folder:
+                            temp_folder = tempfile.mkdtemp(dir=os.path.join(django_settings.BASE_DIR, 'cache'))
+
+                        try:
+                            url = attachment
+                            attachment = os.path.join(temp_folder, os.path.basename(attachment))
+                            with metrics.timer('send.attachment_download'):
+                                utils.download_file(url, attachment)
+                        except:
+                            metrics.increment('send.attachment_failed')
+                            logger.exception(f'EmailQueue.pk="{self.pk}" send attachment failure')
+                            continue
 
-        temp_folder = None
-        if self.attachments:
+                    if os.path.isfile(attachment):
+                        email_message.attach_file(attachment)
+                        metrics.increment('send.attachment_bytes', os.path.getsize(attachment))
 
-            for attachment in self.attachments.split(','):
+            finally:
+                # attach_file reads the file into the message straight away, downloads can go.
+                if temp_folder:
+                    shutil.rmtree(temp_folder, ignore_errors=True)
 
-                if attachment.startswith('http') or attachment.startswith('www'):
+            metrics.timing('send.attachments', time.perf_counter() - attachments_start)
+
+        return email_message
+
+    def get_text_body(self, body=None):
+        """ Plain text part for body (defaults to this emails body), converted from HTML unless PLAIN_TEXT_FROM_HTML is off. """
+        if body is None or body == self.body:
+            if self.text_body:
+                return self.text_body
+            body = self.body
+
+        if not app_settings.PLAIN_TEXT_FROM_HTML:
+            return body
+
+        with get_metrics().timer('send.html_to_text'):
+            return utils.cached_html_to_text(body, maxsize=app_settings.TEXT_BODY_CACHE_SIZE)
+
+    def precompute_text_body(self):
+        """ text_body to store for this emails body, empty (converted when sent) unless PRECOMPUTE_TEXT_BODY is on. """
+        if app_settings.PLAIN_TEXT_FROM_HTML and app_settings.PRECOMPUTE_TEXT_BODY:
+            return utils.cached_html_to_text(self.body, maxsize=app_settings.TEXT_BODY_CACHE_SIZE)
+        return ''
+
+    def get_payload_key(self):
+        return utils.hash_key(self.subject, self.body, self.text_body, self.attachments)
+
+    def is_batchable(self):
+        """ Whether this email can share an SMTP transaction with others that have the same payload. """
+        return bool(self.send_to) and not (self.cc_to or self.bcc_to or self.reply_to or self.digest_minutes)
+
+    @staticmethod
+    def group_identical(emails):
+        """ Groups emails by subject, body and attachments, digest emails are always on their own.
 
-                    if not temp_folder:
-                        temp_folder = tempfile.mkdtemp(dir=os.path.join(django_settings.BASE_DIR, 'cache'))
+        Returns:
+            list: lists of EmailQueue objects, in the order the first of each group appeared.
+        """
+        groups = {}
+        for email in emails:
+            key = email.pk if email.digest_minutes else email.get_payload_key()
+            groups.setdefault(key, []).append(email)
+        return list(groups.values())
 
-                    try:
-                        url = attachment
-                        attachment = os.path.join(temp_folder, os.path.basename(attachment))
-                        utils.download_file(url, attachment)
-                    except:
-                        logger.exception(f'EmailQueue.pk="{self.pk}" send attachment failure')
-                        continue
+    @staticmethod
+    def send_batch(emails, prepared, connection=None):
+        """ Sends emails with identical payloads as one message, recipients are only in the envelope.
 
-                if os.path.isfile(attachment):
-                    email_message.attach_file(attachment)
+        Args:
+            emails: is_batchable() EmailQueue objects sharing the same get_payload_key().
+            prepared: MIME message built from the first email, see send().
+            connection: Email backend connection to send through.
+        """
+        metrics = get_metrics()
+        start = time.perf_counter()
+
+        email_message = PreparedEmailMessage(
+            prepared,
+            connection=connection,
+            bcc=list(utils.unique_emails(*[e.send_to for e in emails])),
+            headers={'To': app_settings.BULK_BATCH_TO_HEADER},
+        )
 
         try:
-            email_message.send()
-            self.sent = True
-            self.date_sent = timezone.now()
-            self.save()
-        except:
+            with metrics.timer('send.smtp'):
+                email_message.send()
+            date_sent = timezone.now()
+            with metrics.timer('send.save'):
+                EmailQueue.objects.filter(pk__in=[e.pk for e in emails]).update(sent=True, date_sent=date_sent)
+        except Exception as e:
+            metrics.increment('send.failed', len(emails), error=e.__class__.__name__)
+            for email in emails:
+                signals.email_send_failed.send(sender=EmailQueue, instance=email, exception=e)
             raise
 
-        finally:
-            if temp_folder:
-                shutil.rmtree(temp_folder, ignore_errors=True)
+        seconds = time.perf_counter() - start
+        metrics.increment('send.sent', len(emails))
+        metrics.increment('send.batched', len(emails))
+        metrics.timing('send.total', seconds)
+        for email in emails:
+            email.sent = True
+            email.date_sent = date_sent
+            signals.email_sent.send(sender=EmailQueue, instance=email, seconds=seconds)
 
-        return self.sent
+    # The only fields is_due reads, emailqueue_send loads just these until a row is due.
+    DUE_FIELDS = ('pk', 'inserted', 'send_at', 'send_after_minutes', 'digest_minutes')
+
+    def is_due(self, now=None):
+        """ Whether send_at/send_after_minutes and the digest window have passed. """
+        now = now or timezone.now()
+
+        if (self.send_at or self.send_after_minutes) and self.send_at_this_time() > now:
+            return False
+
+        if self.digest_minutes and self.pk and self.inserted + datetime.timedelta(minutes=self.digest_minutes) > now:
+            return False
+
+        return True
+
+    def due_at(self):
+        """ When is_due turns True for a saved email. """
+        due = self.send_at_this_time()
+        if self.digest_minutes:
+            due = max(due, self.inserted + datetime.timedelta(minutes=self.digest_minutes))
+        return due
+
+    def get_digest_queryset(self, within=None):
+        """ Unsent emails coalesced into this one when sent as a digest.
+
+        Matches on template, recipients and the model_one/model_two linkage, limited to
+        emails inserted before this emails digest window closes.
+
+        Args:
+            within: EmailQueue queryset to collect from, a sharded sender passes its own shards
+                    so two senders never coalesce the same email.
+        """
+        return (within if within is not None else EmailQueue.objects).filter(
+            sent=False,
+            template_name=self.template_name,
+            send_to=self.send_to,
+            cc_to=self.cc_to,
+            bcc_to=self.bcc_to,
+            model_one_name=self.model_one_name,
+            model_one_id=self.model_one_id,
+            model_two_name=self.model_two_name,
+            model_two_id=self.model_two_id,
+            inserted__lte=self.inserted + datetime.timedelta(minutes=self.digest_minutes),
+        ).exclude(pk=self.pk).order_by('inserted', 'pk')
 
     def send_at_this_time(self):
+        if self.send_at:
+            return self.send_at
         return self.inserted + datetime.timedelta(minutes=self.send_after_minutes or 0)
 
     def seconds_until_sent(self):
@@ -356,6 +721,22 @@ class EmailQueue(BaseEmailFields):
     def __str__(self):
         return f'{self.send_to}: {self.subject}'
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # save() compares against it to tell when body changed under a stored text_body.
+        instance._loaded_body = instance.__dict__.get('body')
+        return instance
+
+    def save(self, *args, **kwargs):
+        loaded_body = self.__dict__.get('_loaded_body')
+        if loaded_body is not None and self.body != loaded_body:
+            # Edited in the admin or elsewhere, the stored plain text part no longer matches.
+            self.text_body = self.precompute_text_body()
+
+        super().save(*args, **kwargs)
+        self._loaded_body = self.__dict__.get('body')
+
     def cancel_send(self, user):
         self.template_name = '{} - Undo by {} on {}'.format(
             self.template_name,
@@ -377,10 +758,73 @@ class EmailQueue(BaseEmailFields):
         if getattr(model_one, 'pk', None):
             self.model_one_name = model_one.__class__.__name__
             self.model_one_id = model_one.pk
+            if self.links_content_type(model_one):
+                self.model_one_object = model_one
 
         if getattr(model_two, 'pk', None):
             self.model_two_name = model_two.__class__.__name__
             self.model_two_id = model_two.pk
+            if self.links_content_type(model_two):
+                self.model_two_object = model_two
+
+    @staticmethod
+    def links_content_type(obj):
+        return app_settings.LINK_CONTENT_TYPES and isinstance(obj.pk, int) and obj.pk >= 0
+
+    @staticmethod
+    def model_lookup(position, obj):
+        """ Q matching emails linked to obj as model_one or model_two (position 'one' or 'two'). """
+        return EmailQueue.models_lookup(position, obj.__class__, [obj.pk])
+
+    @staticmethod
+    def models_lookup(position, model, pks):
+        """ Q matching emails linked as model_one or model_two to any instance of model with one of pks.
+
+        With LINK_CONTENT_TYPES the indexed ContentType columns are matched, along with the name
+        and id strings of emails queued before it was enabled, which have no ContentType.
+        """
+        legacy = models.Q(**{f'model_{position}_name': model.__name__, f'model_{position}_id__in': [str(pk) for pk in pks]})
+        if not app_settings.LINK_CONTENT_TYPES or not all(isinstance(pk, int) and pk >= 0 for pk in pks):
+            return legacy
+
+        linked = models.Q(**{
+            f'model_{position}_type': ContentType.objects.get_for_model(model),
+            f'model_{position}_object_id__in': pks,
+        })
+        return linked | (models.Q(**{f'model_{position}_type__isnull': True}) & legacy)
+
+    @staticmethod
+    def prefetch_for(objects, attr='queued_emails', queryset=None):
+        """ Sets attr on every object to the list of emails linked to it as model_one.
+
+        Uses one query per model instead of one per object. A QueuedEmails accessor of the
+        same name returns the list instead of querying.
+
+        Args:
+            objects: model instances.
+            attr: attribute name to store the list of emails under.
+            queryset: EmailQueue queryset to filter, for ordering or only().
+
+        Returns:
+            list: the objects.
+        """
+        objects = list(objects)
+        by_model = {}
+        for obj in objects:
+            by_model.setdefault(obj.__class__, []).append(obj)
+
+        for model, objs in by_model.items():
+            emails = {}
+            linked = (queryset if queryset is not None else EmailQueue.objects.all()).filter(
+                EmailQueue.models_lookup('one', model, [o.pk for o in objs]),
+            )
+            for email in linked:
+                key = email.model_one_object_id if email.model_one_object_id is not None else email.model_one_id
+                emails.setdefault(str(key), []).append(email)
+            for obj in objs:
+                setattr(obj, attr, emails.get(str(obj.pk), []))
+
+        return objects
 
     @staticmethod
     def search_for(model_one=None, model_two=None, search_both=False, *args, **kwargs):
@@ -404,18 +848,15 @@ class EmailQueue(BaseEmailFields):
         # items where model_one OR model_two equals the model_one supplied object.
         if search_both and getattr(model_one, 'pk', None):
 
-            eqf = eqf.filter(
-                models.Q(model_one_name=model_one.__class__.__name__, model_one_id=model_one.pk) |
-                models.Q(model_two_name=model_one.__class__.__name__, model_two_id=model_one.pk),
-            )
+            eqf = eqf.filter(EmailQueue.model_lookup('one', model_one) | EmailQueue.model_lookup('two', model_one))
 
         else:
 
             if getattr(model_one, 'pk', None):
-                eqf = eqf.filter(model_one_name=model_one.__class__.__name__, model_one_id=model_one.pk)
+                eqf = eqf.filter(EmailQueue.model_lookup('one', model_one))
 
             if getattr(model_two, 'pk', None):
-                eqf = eqf.filter(model_two_name=model_two.__class__.__name__, model_two_id=model_two.pk)
+                eqf = eqf.filter(EmailQueue.model_lookup('two', model_two))
 
         return eqf
 
@@ -445,3 +886,51 @@ class EmailQueue(BaseEmailFields):
     #                 logger.debug(traceback.format_exc())
     #
     #     return links, deleted
+
+
+class QueuedEmails(object):
+    """ Accessor for the emails linked to an object as model_one.
+
+        class Order(models.Model):
+            queued_emails = QueuedEmails()
+
+        order.queued_emails.filter(sent=False)
+        EmailQueue.prefetch_for(orders)  # order.queued_emails is then a list
+
+    Unlike a GenericRelation, deleting the object doesn't delete its email history.
+    """
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return EmailQueue.objects.filter(EmailQueue.model_lookup('one', instance))
+
+
+class SenderNode(models.Model):
+    """ An emailqueue_send --shards node that is alive until expires, see sharding.ShardLeases. """
+
+    class Meta:
+        verbose_name = 'Sender Node'
+
+    name = models.CharField(max_length=255, primary_key=True)
+    expires = models.DateTimeField()
+
+    def __str__(self):
+        return self.name
+
+
+class SenderLease(models.Model):
+    """ Which emailqueue_send node currently owns a shard of EmailQueue.
+
+        Used by emailqueue_send --shards N --node NAME, see sharding.ShardLeases.
+    """
+
+    class Meta:
+        verbose_name = 'Sender Lease'
+
+    shard = models.IntegerField(primary_key=True)
+    owner = models.CharField(max_length=255, blank=True)
+    expires = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.shard}: {self.owner}'
@@ -0,0 +1,95 @@
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.template import Template, Context
+
+from . import utils
+from .app_settings import app_settings
+
+DJANGO = 'django'
+JINJA2 = 'jinja2'
+
+ENGINE_CHOICES = (
+    (DJANGO, 'Django'),
+    (JINJA2, 'Jinja2'),
+)
+
+_environments = {}
+_lock = threading.Lock()
+
+
+def render(source, context, engine=None):
+    """ Renders a subject or body template string with the selected engine.
+
+    Args:
+        source: template source.
+        context: dict of context variables.
+        engine: DJANGO or JINJA2, defaults to TEMPLATED_EMAILER_RENDER_ENGINE.
+
+    Returns:
+        str: rendered output.
+    """
+    engine = engine or app_settings.RENDER_ENGINE
+
+    if engine == JINJA2:
+        return render_jinja2(source, context)
+    if engine == DJANGO:
+        return Template(source).render(context=Context(context))
+
+    raise ImproperlyConfigured(f'Unknown render engine "{engine}", use one of {[e for e, _ in ENGINE_CHOICES]}')
+
+
+def render_jinja2(source, context):
+    environment, loader = get_jinja2_environment()
+
+    # Templates are looked up by the hash of their source so the environment's compiled template
+    # cache, and the bytecode cache when configured, are reused for identical subjects and bodies.
+    # The loader only holds the source being looked up, so lookups from other threads must wait.
+    name = utils.hash_key(source)
+    with _lock:
+        loader.sources[name] = source
+        try:
+            template = environment.get_template(name)
+        finally:
+            loader.sources.pop(name, None)
+
+    return template.render(context)
+
+
+def get_jinja2_environment():
+    """ Returns the sandboxed jinja2 environment and its loader, one per configuration. """
+    key = (app_settings.JINJA2_BYTECODE_CACHE_DIR, app_settings.JINJA2_CACHE_SIZE, app_settings.JINJA2_AUTOESCAPE)
+    if key in _environments:
+        return _environments[key]
+
+    try:
+        import jinja2
+        from jinja2.sandbox import SandboxedEnvironment
+    except ImportError:
+        raise ImproperlyConfigured('The jinja2 render engine requires jinja2: pip install django-templated-emailer[jinja2]')
+
+    class SourceLoader(jinja2.BaseLoader):
+        def __init__(self):
+            self.sources = {}
+
+        def get_source(self, environment, template):
+            if template not in self.sources:
+                raise jinja2.TemplateNotFound(template)
+            # The name is the hash of the source, so a cached template is always up to date.
+            return self.sources[template], None, lambda: True
+
+    bytecode_cache = None
+    if app_settings.JINJA2_BYTECODE_CACHE_DIR:
+        bytecode_cache = jinja2.FileSystemBytecodeCache(app_settings.JINJA2_BYTECODE_CACHE_DIR)
+
+    loader = SourceLoader()
+    environment = SandboxedEnvironment(
+        loader=loader,
+        bytecode_cache=bytecode_cache,
+        cache_size=app_settings.JINJA2_CACHE_SIZE,
+        autoescape=app_settings.JINJA2_AUTOESCAPE,
+        auto_reload=False,
+    )
+
+    _environments[key] = environment, loader
+    return _environments[key]
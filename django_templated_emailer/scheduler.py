@@ -0,0 +1,144 @@
+import datetime
+import logging
+import zoneinfo
+
+from django.utils import timezone
+
+logger = logging.getLogger('django_templated_emailer')
+
+
+def get_timezone(tz=None):
+    """ Returns a tzinfo for a timezone name or tzinfo, defaulting to the current django timezone.
+
+    An unknown timezone name is logged and the current django timezone is used instead.
+    """
+    if not tz:
+        return timezone.get_current_timezone()
+    if isinstance(tz, str):
+        try:
+            return zoneinfo.ZoneInfo(tz)
+        except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+            logger.warning(f'Unknown timezone "{tz}", using {timezone.get_current_timezone_name()}')
+            return timezone.get_current_timezone()
+    return tz
+
+
+def in_window(value, start, end):
+    """ Whether the time value falls inside the start/end window.
+
+    A window where start is after end wraps midnight (22:00 - 06:00), a window where both are
+    equal or either is missing is always open.
+    """
+    if not start or not end or start == end:
+        return True
+    if start < end:
+        return start <= value < end
+    return value >= start or value < end
+
+
+def next_in_window(when, start, end, tz=None):
+    """ Returns when if it falls in the send window in timezone tz, otherwise the next time the window opens.
+
+    Args:
+        when: aware datetime the email would otherwise be sent at.
+        start: datetime.time the window opens, in the recipient timezone.
+        end: datetime.time the window closes, in the recipient timezone.
+        tz: recipient timezone name or tzinfo, defaults to the current django timezone.
+
+    Returns:
+        datetime: aware datetime inside the window.
+    """
+    tz = get_timezone(tz)
+    local = when.astimezone(tz)
+
+    if in_window(local.time(), start, end):
+        return when
+
+    opens = datetime.datetime.combine(local.date(), start).replace(tzinfo=tz)
+    if opens <= local:
+        opens = datetime.datetime.combine(local.date() + datetime.timedelta(days=1), start).replace(tzinfo=tz)
+    return opens
+
+
+def open_intervals(start, end, window_start, window_end, tz=None):
+    """ Returns the (opens, closes) aware datetime pairs the send window is open for between start and end. """
+    if not window_start or not window_end or window_start == window_end:
+        return [(start, end)] if start < end else []
+
+    tz = get_timezone(tz)
+    intervals = []
+    day = start.astimezone(tz).date() - datetime.timedelta(days=1)
+    while True:
+        opens = datetime.datetime.combine(day, window_start).replace(tzinfo=tz)
+        if opens >= end:
+            return intervals
+        close_day = day + datetime.timedelta(days=1) if window_end <= window_start else day
+        closes = datetime.datetime.combine(close_day, window_end).replace(tzinfo=tz)
+        if closes > start:
+            intervals.append((max(opens, start), min(closes, end)))
+        day += datetime.timedelta(days=1)
+
+
+def spread_send_at(queryset, start, end, batch_size=1000):
+    """ Spreads the send_at of every unsent email in queryset evenly between start and end.
+
+    Use this after queueing a bulk campaign so emailqueue_send drains it at a steady rate
+    instead of trying to push everything to the provider at once. Emails whose template has a
+    send window are spread evenly over the time that window is open between start and end, in
+    their send_timezone. If the window never opens in that range they are spread over its next opening.
+
+    Args:
+        queryset: EmailQueue queryset to schedule, ordered by pk.
+        start: aware datetime the first email goes out.
+        end: aware datetime the last email goes out.
+        batch_size: rows per UPDATE statement.
+
+    Returns:
+        int: number of emails scheduled.
+    """
+    from .models import EmailTemplate
+
+    rows = list(queryset.filter(sent=False).order_by('pk').values_list('pk', 'template_name', 'send_timezone'))
+    if not rows:
+        return 0
+
+    windows = {
+        name: (window_start, window_end)
+        for name, window_start, window_end in EmailTemplate.objects.filter(
+            name__in={row[1] for row in rows}, send_window_start__isnull=False, send_window_end__isnull=False,
+        ).values_list('name', 'send_window_start', 'send_window_end')
+    }
+
+    # Emails sharing a window and timezone are spread over the same open intervals.
+    groups = {}
+    for pk, template_name, send_timezone in rows:
+        window = windows.get(template_name)
+        groups.setdefault((window, send_timezone if window else None), []).append(pk)
+
+    model = queryset.model
+    emails = []
+    for (window, send_timezone), pks in groups.items():
+        if not window:
+            step = (end - start) / max(len(pks) - 1, 1)
+            emails.extend(model(pk=pk, send_at=start + step * i) for i, pk in enumerate(pks))
+            continue
+
+        intervals = open_intervals(start, end, *window, tz=send_timezone)
+        if not intervals:
+            opens = next_in_window(start, *window, tz=send_timezone)
+            intervals = open_intervals(opens, opens + datetime.timedelta(days=1), *window, tz=send_timezone)[:1]
+
+        # Offsets into the total open time, stepping by total / count so none lands on a window closing.
+        step = sum((closes - opens for opens, closes in intervals), datetime.timedelta()) / len(pks)
+        interval = 0
+        passed = datetime.timedelta()
+        for i, pk in enumerate(pks):
+            offset = step * i
+            while offset - passed >= intervals[interval][1] - intervals[interval][0] and interval < len(intervals) - 1:
+                passed += intervals[interval][1] - intervals[interval][0]
+                interval += 1
+            emails.append(model(pk=pk, send_at=intervals[interval][0] + (offset - passed)))
+
+    model.objects.bulk_update(emails, ['send_at'], batch_size=batch_size)
+
+    return len(emails)
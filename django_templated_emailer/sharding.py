@@ -0,0 +1,73 @@
+import datetime
+import math
+import os
+import socket
+
+from django.db.models.functions import Mod
+from django.utils import timezone
+
+from .app_settings import app_settings
+from .models import SenderLease, SenderNode
+
+
+def default_node_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def filter_shards(queryset, shards, total):
+    """ Limits queryset to rows where pk % total is one of shards. """
+    return queryset.annotate(dte_shard=Mod('pk', total)).filter(dte_shard__in=list(shards))
+
+
+class ShardLeases(object):
+    """ Shares total shards fairly between live nodes using SenderLease rows as heartbeated leases.
+
+    Every call to heartbeat() marks this node alive in SenderNode, renews its leases, gives up
+    any above its fair share and claims expired or released ones below it. Claims are
+    compare-and-set updates, so a shard is never owned by two live nodes. When a node dies its
+    leases expire and the survivors pick them up on their next heartbeat.
+    """
+
+    def __init__(self, owner, total, ttl=None):
+        self.owner = owner
+        self.total = total
+        self.ttl = datetime.timedelta(seconds=ttl or app_settings.SHARD_LEASE_SECONDS)
+        self.shards = []
+
+        SenderLease.objects.bulk_create(
+            [SenderLease(shard=shard, owner='', expires=timezone.now()) for shard in range(total)],
+            ignore_conflicts=True,
+        )
+
+    def heartbeat(self):
+        """ Renews, releases and claims leases. Returns the sorted list of shards this node owns. """
+        now = timezone.now()
+        expires = now + self.ttl
+        leases = SenderLease.objects.filter(shard__lt=self.total)
+
+        SenderNode.objects.update_or_create(name=self.owner, defaults={'expires': expires})
+        leases.filter(owner=self.owner).update(expires=expires)
+
+        live = SenderNode.objects.filter(expires__gt=now).count()
+        fair = math.ceil(self.total / max(live, 1))
+
+        mine = sorted(leases.filter(owner=self.owner).values_list('shard', flat=True))
+
+        if len(mine) > fair:
+            leases.filter(owner=self.owner, shard__in=mine[fair:]).update(owner='', expires=now)
+            mine = mine[:fair]
+
+        elif len(mine) < fair:
+            for shard in leases.filter(expires__lte=now).order_by('shard').values_list('shard', flat=True):
+                if leases.filter(shard=shard, expires__lte=now).update(owner=self.owner, expires=expires):
+                    mine.append(shard)
+                if len(mine) >= fair:
+                    break
+
+        self.shards = sorted(mine)
+        return self.shards
+
+    def release(self):
+        SenderNode.objects.filter(name=self.owner).delete()
+        SenderLease.objects.filter(owner=self.owner).update(owner='', expires=timezone.now())
+        self.shards = []
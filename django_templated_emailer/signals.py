@@ -0,0 +1,9 @@
+from django.dispatch import Signal
+
+# Sent after an EmailQueue object was handed to the email backend and saved as sent.
+# Receives instance and seconds (time spent inside EmailQueue.send).
+email_sent = Signal()
+
+# Sent when EmailQueue.send raises, before the exception is re-raised.
+# Receives instance and exception.
+email_send_failed = Signal()
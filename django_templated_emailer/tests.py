@@ -1,8 +1,30 @@
+import datetime
+import importlib.util
+import json
+import os
+import signal
+import sys
+import tempfile
+import threading
+import zoneinfo
+from unittest import mock, skipUnless
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
 from django.test import TestCase
 from django.test.utils import override_settings
+from django.utils import timezone
 
-from .utils import unique_emails
-from .models import EmailQueue, EmailTemplate
+from . import backends, rendering, scheduler, signals, wakeup
+from .management.commands import emailqueue_send
+from .admin import EmailQueueAdmin, EstimatedCountPaginator
+from .metrics import get_metrics
+from .sharding import ShardLeases
+from .utils import html_to_text, unique_emails
+from .models import EmailQueue, EmailTemplate, QueuedEmails, SenderLease, SenderNode
 
 
 class TestUtils(TestCase):
@@ -53,6 +75,13 @@ class TestUtils(TestCase):
         ue = unique_emails(self.emails, {'fails': 'test@domain.com'})
         self.assertEqual(3, len(ue))
 
+    def test_html_to_text(self):
+
+        html = '<html><head><style>p {}</style></head><body><h1>Hi &amp; bye</h1>' \
+               '<ul><li>one</li><li>two</li></ul>line<br>two <a href="https://example.com">link</a></body></html>'
+        self.assertEqual('Hi & bye\n\n- one\n- two\n\nline\ntwo link (https://example.com)', html_to_text(html))
+        self.assertEqual('Plain\ntext', html_to_text('Plain\ntext'))
+
 
 class TestEmailQueueQueueEmail(TestCase):
 
@@ -104,3 +133,700 @@ class TestEmailQueueQueueEmail(TestCase):
         )
         self.assertEqual('Test', eq.subject)
         self.assertEqual('Test Body! test here in method', eq.body)
+
+    def test_delete_unsent_matching_replaces(self):
+        first = EmailQueue.queue_email(template_name='Test Template', send_to='test@domain.com', domain='one')
+        other = EmailQueue.queue_email(template_name='Test Template', send_to='other@domain.com', domain='one')
+
+        second = EmailQueue.queue_email(
+            template_name=self.template,
+            send_to='test@domain.com',
+            delete_unsent_matching=True,
+            domain='two',
+        )
+
+        self.assertEqual(first.dedup_key, second.dedup_key)
+        self.assertEqual(2, EmailQueue.objects.count())
+        self.assertFalse(EmailQueue.objects.filter(pk=first.pk).exists())
+        self.assertEqual('Test Body! two', EmailQueue.objects.get(pk=second.pk).body)
+        self.assertTrue(EmailQueue.objects.filter(pk=other.pk).exists())
+
+    def test_delete_unsent_matching_while_sending(self):
+        EmailQueue.queue_email(template_name='Test Template', send_to='test@domain.com', domain='one')
+        # A sender loaded the old email before it was replaced.
+        stale = EmailQueue.objects.get()
+
+        EmailQueue.queue_email(template_name='Test Template', send_to='test@domain.com', delete_unsent_matching=True, domain='two')
+        stale.send()
+
+        self.assertEqual('Test Body! two', EmailQueue.objects.get(sent=False).body)
+
+
+@override_settings(TEMPLATED_EMAILER_METRICS_BACKEND='django_templated_emailer.metrics.PrometheusMetrics')
+class TestMetrics(TestCase):
+
+    def setUp(self) -> None:
+        EmailTemplate.objects.create(name='Test Template', subject='Test', body='Test Body!')
+        self.metrics = get_metrics()
+        self.metrics.reset()
+
+    def test_send_records_stage_timings(self):
+        EmailQueue.queue_email(template_name='Test Template', send_to='test@domain.com', send_immediately=True)
+
+        output = self.metrics.render()
+        self.assertIn('django_templated_emailer_send_sent_total 1', output)
+        self.assertIn('django_templated_emailer_send_smtp_seconds_count 1', output)
+        self.assertIn('django_templated_emailer_prepare_render_seconds_count{engine="django"} 1', output)
+
+    def test_emailqueue_send_reports_queue_depth(self):
+        EmailQueue.queue_email(template_name='Test Template', send_to='test@domain.com')
+        EmailQueue.queue_email(template_name='Test Template', send_to='test@domain.com', send_after_minutes=60)
+
+        sent = []
+        signals.email_sent.connect(lambda instance, **kwargs: sent.append(instance), weak=False, dispatch_uid='test')
+        try:
+            call_command('emailqueue_send')
+        finally:
+            signals.email_sent.disconnect(dispatch_uid='test')
+
+        self.assertEqual(1, len(sent))
+        self.assertIn('django_templated_emailer_queue_depth 2', self.metrics.render())
+
+    def test_emailqueue_send_flushes_when_sending_fails(self):
+        with mock.patch.object(emailqueue_send.Command, 'send_queued', side_effect=RuntimeError), \
+                mock.patch.object(self.metrics, 'flush') as flush:
+            with self.assertRaises(RuntimeError):
+                call_command('emailqueue_send')
+        flush.assert_called_once_with()
+
+
+class TestScheduler(TestCase):
+
+    def setUp(self) -> None:
+        self.template = EmailTemplate.objects.create(
+            name='Windowed Template',
+            subject='Test',
+            body='Test Body!',
+            send_window_start=datetime.time(8),
+            send_window_end=datetime.time(21),
+        )
+
+    def test_next_in_window(self):
+        tz = zoneinfo.ZoneInfo('America/Toronto')
+        inside = datetime.datetime(2020, 1, 1, 12, tzinfo=tz)
+        self.assertEqual(inside, scheduler.next_in_window(inside, datetime.time(8), datetime.time(21), tz))
+
+        late = datetime.datetime(2020, 1, 1, 22, tzinfo=tz)
+        self.assertEqual(
+            datetime.datetime(2020, 1, 2, 8, tzinfo=tz),
+            scheduler.next_in_window(late, datetime.time(8), datetime.time(21), tz)
+        )
+
+        early = datetime.datetime(2020, 1, 1, 3, tzinfo=tz)
+        self.assertEqual(
+            datetime.datetime(2020, 1, 1, 8, tzinfo=tz),
+            scheduler.next_in_window(early, datetime.time(8), datetime.time(21), tz)
+        )
+
+    def test_wrapping_window(self):
+        self.assertTrue(scheduler.in_window(datetime.time(23), datetime.time(22), datetime.time(6)))
+        self.assertTrue(scheduler.in_window(datetime.time(5), datetime.time(22), datetime.time(6)))
+        self.assertFalse(scheduler.in_window(datetime.time(12), datetime.time(22), datetime.time(6)))
+
+    def test_queue_email_applies_recipient_timezone_window(self):
+        # 03:00 UTC is 22:00 the previous day in Toronto, outside the window.
+        when = datetime.datetime(2020, 1, 1, 3, tzinfo=datetime.timezone.utc)
+        eq = EmailQueue.queue_email(
+            template_name='Windowed Template',
+            send_to='test@domain.com',
+            send_at=when,
+            send_timezone='America/Toronto',
+        )
+        self.assertEqual(datetime.datetime(2020, 1, 1, 13, tzinfo=datetime.timezone.utc), eq.send_at)
+        self.assertEqual(eq.send_at, eq.send_at_this_time())
+
+    def test_future_send_at_is_not_sent(self):
+        eq = EmailQueue.queue_email(template_name='Windowed Template', send_to='test@domain.com', send_at=datetime.datetime(2999, 1, 1, tzinfo=datetime.timezone.utc))
+        self.assertFalse(eq.send())
+
+    def test_spread_send_at(self):
+        EmailTemplate.objects.create(name='Plain Template', subject='Test', body='Test Body!')
+        for i in range(5):
+            EmailQueue.queue_email(template_name='Plain Template', send_to=f'test{i}@domain.com')
+
+        start = datetime.datetime(2020, 1, 1, 12, tzinfo=datetime.timezone.utc)
+        end = start + datetime.timedelta(hours=1)
+        self.assertEqual(5, scheduler.spread_send_at(EmailQueue.objects.all(), start, end))
+
+        send_ats = list(EmailQueue.objects.order_by('pk').values_list('send_at', flat=True))
+        self.assertEqual(start, send_ats[0])
+        self.assertEqual(end, send_ats[-1])
+        self.assertEqual(datetime.timedelta(minutes=15), send_ats[1] - send_ats[0])
+
+    def test_spread_send_at_respects_window(self):
+        for i in range(100):
+            EmailQueue.queue_email(template_name='Windowed Template', send_to=f'test{i}@domain.com', send_timezone='UTC')
+
+        start = datetime.datetime(2020, 1, 1, 12, tzinfo=datetime.timezone.utc)
+        self.assertEqual(100, scheduler.spread_send_at(EmailQueue.objects.all(), start, start + datetime.timedelta(hours=24)))
+
+        send_ats = list(EmailQueue.objects.order_by('pk').values_list('send_at', flat=True))
+        self.assertEqual(100, len(set(send_ats)))
+        self.assertTrue(all(scheduler.in_window(s.time(), datetime.time(8), datetime.time(21)) for s in send_ats))
+        # 12:00-21:00 and 08:00-12:00 the next day are open, 13 hours for 100 emails.
+        self.assertEqual(start, send_ats[0])
+        self.assertEqual(datetime.timedelta(hours=13) / 100, send_ats[1] - send_ats[0])
+
+    def test_spread_send_at_closed_range(self):
+        for i in range(3):
+            EmailQueue.queue_email(template_name='Windowed Template', send_to=f'test{i}@domain.com', send_timezone='UTC')
+
+        start = datetime.datetime(2020, 1, 1, 22, tzinfo=datetime.timezone.utc)
+        scheduler.spread_send_at(EmailQueue.objects.all(), start, start + datetime.timedelta(hours=1))
+
+        send_ats = list(EmailQueue.objects.order_by('pk').values_list('send_at', flat=True))
+        opens = datetime.datetime(2020, 1, 2, 8, tzinfo=datetime.timezone.utc)
+        self.assertEqual([opens, opens + datetime.timedelta(hours=13) / 3, opens + datetime.timedelta(hours=26) / 3], send_ats)
+
+    def test_invalid_timezone_falls_back(self):
+        with self.assertLogs('django_templated_emailer', 'WARNING'):
+            eq = EmailQueue.queue_email(template_name='Windowed Template', send_to='test@domain.com', send_timezone='Not/A_Zone')
+        self.assertTrue(eq.pk)
+
+
+class TestDigest(TestCase):
+
+    def setUp(self) -> None:
+        EmailTemplate.objects.create(name='Comment', subject='New comment', body='{{ comment }}', digest_minutes=10)
+
+    def test_digest_coalesces_matching_emails(self):
+        for comment in ['First', 'Second', 'Third']:
+            EmailQueue.queue_email(template_name='Comment', send_to='test@domain.com', comment=comment,
+                                   model_one_name='Post', model_one_id='1')
+        EmailQueue.queue_email(template_name='Comment', send_to='test@domain.com', comment='Other post',
+                               model_one_name='Post', model_one_id='2')
+
+        call_command('emailqueue_send')
+        self.assertEqual(0, len(mail.outbox))
+
+        EmailQueue.objects.update(inserted=timezone.now() - datetime.timedelta(minutes=11))
+        call_command('emailqueue_send')
+
+        self.assertEqual(2, len(mail.outbox))
+        digest = next(m for m in mail.outbox if 'First' in m.body)
+        self.assertEqual('New comment (+2 more)', digest.subject)
+        self.assertEqual('First<hr>Second<hr>Third', digest.alternatives[0][0])
+        self.assertEqual('First\n\nSecond\n\nThird', digest.body)
+        self.assertFalse(EmailQueue.objects.filter(sent=False).exists())
+
+    def test_digest_attaches_each_file_once(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, 'terms.bin')
+            with open(path, 'wb') as f:
+                f.write(b'terms')
+            EmailTemplate.objects.filter(name='Comment').update(attachments=path)
+
+            for comment in ['First', 'Second', 'Third']:
+                EmailQueue.queue_email(template_name='Comment', send_to='test@domain.com', comment=comment)
+            EmailQueue.objects.update(inserted=timezone.now() - datetime.timedelta(minutes=11))
+            call_command('emailqueue_send')
+
+        self.assertEqual(1, len(mail.outbox))
+        self.assertEqual(['terms.bin'], [a[0] for a in mail.outbox[0].attachments])
+
+
+class TestEmailQueueSendDaemon(TestCase):
+
+    def setUp(self) -> None:
+        EmailTemplate.objects.create(name='Test Template', subject='Test', body='Test Body!')
+
+    def test_polling_waker_wake(self):
+        waker = wakeup.PollingWaker()
+        try:
+            waker.wake()
+            self.assertTrue(waker.wait(5))
+            self.assertFalse(waker.wait(0))
+        finally:
+            waker.close()
+
+    def test_seconds_until_next_includes_delays(self):
+        command = emailqueue_send.Command()
+        self.assertEqual(300, command.seconds_until_next(300))
+
+        EmailQueue.queue_email(template_name='Test Template', send_to='test@domain.com', send_after_minutes=3)
+        self.assertAlmostEqual(180, command.seconds_until_next(300), delta=5)
+
+        EmailTemplate.objects.create(name='Digest Template', subject='Test', body='Test Body!', digest_minutes=2)
+        EmailQueue.queue_email(template_name='Digest Template', send_to='test@domain.com')
+        self.assertAlmostEqual(120, command.seconds_until_next(300), delta=5)
+
+        EmailQueue.queue_email(template_name='Test Template', send_to='test@domain.com',
+                               send_at=timezone.now() + datetime.timedelta(minutes=1))
+        self.assertAlmostEqual(60, command.seconds_until_next(300), delta=5)
+
+    def get_postgres_waker(self, notifies):
+        waker = wakeup.PostgresWaker.__new__(wakeup.PostgresWaker)
+        wakeup.PollingWaker.__init__(waker)
+        self.addCleanup(wakeup.PollingWaker.close, waker)
+        waker.connection = mock.MagicMock()
+        waker.connection.connection.notifies = notifies
+        return waker
+
+    def test_postgres_waker_drains_psycopg2(self):
+        waker = self.get_postgres_waker(['notify', 'notify'])
+        waker.drain_notifies()
+
+        self.assertEqual([], waker.connection.connection.notifies)
+        waker.connection.cursor.return_value.__enter__.return_value.execute.assert_called_once_with('SELECT 1')
+
+    def test_postgres_waker_drains_psycopg3(self):
+        pending = iter(['notify', 'notify'])
+        waker = self.get_postgres_waker(mock.Mock(return_value=pending))
+        waker.drain_notifies()
+
+        waker.connection.connection.notifies.assert_called_once_with(timeout=0)
+        self.assertEqual([], list(pending))
+        waker.connection.cursor.assert_not_called()
+
+    def test_daemon_sends_and_stops_on_sigterm(self):
+        EmailQueue.queue_email(template_name='Test Template', send_to='test@domain.com')
+        EmailQueue.queue_email(template_name='Test Template', send_to='test2@domain.com')
+        previous = signal.getsignal(signal.SIGTERM)
+
+        with mock.patch.object(wakeup.PollingWaker, 'wait', lambda waker, timeout: os.kill(os.getpid(), signal.SIGTERM)):
+            call_command('emailqueue_send', daemon=True)
+
+        self.assertEqual(2, len(mail.outbox))
+        self.assertIs(previous, signal.getsignal(signal.SIGTERM))
+
+
+class TestSharding(TestCase):
+
+    def setUp(self) -> None:
+        EmailTemplate.objects.create(name='Test Template', subject='Test', body='Test Body!')
+        for i in range(20):
+            EmailQueue.queue_email(template_name='Test Template', send_to=f'test{i}@domain.com')
+
+    def test_static_shards_send_every_email_once(self):
+        for shard in range(3):
+            call_command('emailqueue_send', shard=shard, shards=3)
+
+        recipients = [m.to[0] for m in mail.outbox]
+        self.assertEqual(20, len(recipients))
+        self.assertEqual(20, len(set(recipients)))
+
+    def test_leases_are_disjoint_and_rebalance(self):
+        first = ShardLeases('first', 4)
+        second = ShardLeases('second', 4)
+
+        self.assertEqual([0, 1, 2, 3], first.heartbeat())
+        self.assertEqual([], second.heartbeat())
+
+        # first sees second alive and hands over its extra shards.
+        self.assertEqual([0, 1], first.heartbeat())
+        self.assertEqual([2, 3], second.heartbeat())
+
+        # first dies, its leases expire and second takes over everything.
+        SenderNode.objects.filter(name='first').update(expires=timezone.now() - datetime.timedelta(seconds=1))
+        SenderLease.objects.filter(owner='first').update(expires=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual([0, 1, 2, 3], second.heartbeat())
+
+    def test_lease_mode_sends_every_email_once(self):
+        SenderNode.objects.create(name='other node', expires=timezone.now() + datetime.timedelta(hours=1))
+        SenderLease.objects.bulk_create([
+            SenderLease(shard=shard, owner='other node', expires=timezone.now() + datetime.timedelta(hours=1))
+            for shard in range(2)
+        ])
+        call_command('emailqueue_send', shards=4, node='this node')
+        sent_by_this_node = len(mail.outbox)
+        self.assertTrue(0 < sent_by_this_node < 20)
+
+        SenderNode.objects.filter(name='other node').delete()
+        SenderLease.objects.filter(owner='other node').update(expires=timezone.now() - datetime.timedelta(seconds=1))
+        call_command('emailqueue_send', shards=4, node='this node')
+
+        recipients = [m.to[0] for m in mail.outbox]
+        self.assertEqual(20, len(recipients))
+        self.assertEqual(20, len(set(recipients)))
+
+    def test_interleaved_nodes_send_every_email_once(self):
+        first, second = emailqueue_send.Command(), emailqueue_send.Command()
+        first.total_shards = second.total_shards = 4
+        first.leases, second.leases = ShardLeases('first', 4), ShardLeases('second', 4)
+
+        first.heartbeat()
+        second.heartbeat()
+        self.assertEqual([0, 1, 2, 3], first.shards)
+        self.assertEqual([], second.shards)
+
+        send = EmailQueue.send
+        started = []
+
+        def first_send_interrupted(email, *args, **kwargs):
+            if not started:
+                # first has heartbeated and handed over two shards, second joins while first is mid run.
+                started.append(email)
+                second.heartbeat()
+                second.send_queued()
+            return send(email, *args, **kwargs)
+
+        # Heartbeat on the first email first sends.
+        first.last_heartbeat = -3600
+        with mock.patch.object(EmailQueue, 'send', autospec=True, side_effect=first_send_interrupted):
+            first.send_queued()
+
+        self.assertEqual([0, 1], first.shards)
+        self.assertEqual([2, 3], second.shards)
+        recipients = [m.to[0] for m in mail.outbox]
+        self.assertEqual(20, len(recipients))
+        self.assertEqual(20, len(set(recipients)))
+
+    def test_digest_stays_within_shard(self):
+        EmailTemplate.objects.create(name='Comment', subject='New comment', body='{{ comment }}', digest_minutes=10)
+        EmailQueue.objects.all().delete()
+        for comment in ['First', 'Second']:
+            EmailQueue.queue_email(template_name='Comment', send_to='test@domain.com', comment=comment)
+        EmailQueue.objects.update(inserted=timezone.now() - datetime.timedelta(minutes=11))
+
+        first = EmailQueue.objects.order_by('pk').first()
+        call_command('emailqueue_send', shard=first.pk % 2, shards=2)
+
+        self.assertEqual(1, len(mail.outbox))
+        self.assertEqual('New comment', mail.outbox[0].subject)
+        self.assertEqual(1, EmailQueue.objects.filter(sent=False).count())
+
+
+class TestEmailQueueSend(TestCase):
+
+    def setUp(self) -> None:
+        EmailTemplate.objects.create(name='Test Template', subject='Test', body='Test Body!')
+
+    @override_settings(TEMPLATED_EMAILER_SENDER_CHUNK_SIZE=2)
+    def test_sends_due_emails_in_chunks(self):
+        for i in range(5):
+            EmailQueue.queue_email(template_name='Test Template', send_to=f'test{i}@domain.com')
+        later = EmailQueue.queue_email(template_name='Test Template', send_to='later@domain.com', send_after_minutes=60)
+
+        call_command('emailqueue_send')
+
+        self.assertEqual(5, len(mail.outbox))
+        self.assertEqual([later.pk], list(EmailQueue.objects.filter(sent=False).values_list('pk', flat=True)))
+
+
+class TestIdenticalPayloads(TestCase):
+
+    def setUp(self) -> None:
+        self.attachment = tempfile.NamedTemporaryFile(suffix='.bin')
+        self.attachment.write(b'attached')
+        self.attachment.flush()
+        EmailTemplate.objects.create(name='Newsletter', subject='News', body='Same for everyone', attachments=self.attachment.name)
+        for i in range(3):
+            EmailQueue.queue_email(template_name='Newsletter', send_to=f'test{i}@domain.com')
+        EmailQueue.queue_email(template_name='Newsletter', send_to='cc@domain.com', cc_to='copy@domain.com')
+
+    def tearDown(self) -> None:
+        self.attachment.close()
+
+    def test_identical_emails_build_message_once(self):
+        with mock.patch.object(EmailQueue, 'build_message', autospec=True, side_effect=EmailQueue.build_message) as build:
+            call_command('emailqueue_send')
+
+        self.assertEqual(1, build.call_count)
+        self.assertEqual(4, len(mail.outbox))
+        messages = [m.message() for m in mail.outbox]
+        self.assertEqual(['test0@domain.com', 'test1@domain.com', 'test2@domain.com', 'cc@domain.com'], [m['To'] for m in messages])
+        self.assertEqual('copy@domain.com', messages[3]['Cc'])
+        self.assertEqual(4, len({m['Message-ID'] for m in messages}))
+        self.assertTrue(all(b'YXR0YWNoZWQ=' in m.as_bytes() for m in messages))
+
+    @override_settings(TEMPLATED_EMAILER_BULK_BATCH_SIZE=10)
+    def test_bulk_batch_sends_one_transaction(self):
+        call_command('emailqueue_send')
+
+        self.assertEqual(2, len(mail.outbox))
+        batched = mail.outbox[0]
+        self.assertEqual(['test0@domain.com', 'test1@domain.com', 'test2@domain.com'], sorted(batched.recipients()))
+        self.assertEqual('undisclosed-recipients:;', batched.message()['To'])
+        self.assertFalse(EmailQueue.objects.filter(sent=False).exists())
+
+
+class TestPlainTextBody(TestCase):
+
+    def setUp(self) -> None:
+        EmailTemplate.objects.create(name='Html Template', subject='Test', body='<p>Hello {{ name }}</p>')
+
+    def test_text_part_is_converted(self):
+        EmailQueue.queue_email(template_name='Html Template', send_to='test@domain.com', name='there', send_immediately=True)
+
+        self.assertEqual('Hello there', mail.outbox[0].body)
+        self.assertEqual(('<p>Hello there</p>', 'text/html'), tuple(mail.outbox[0].alternatives[0]))
+
+    @override_settings(TEMPLATED_EMAILER_PRECOMPUTE_TEXT_BODY=True)
+    def test_text_body_precomputed(self):
+        eq = EmailQueue.queue_email(template_name='Html Template', send_to='test@domain.com', name='there')
+        self.assertEqual('Hello there', eq.text_body)
+
+        EmailQueue.objects.filter(pk=eq.pk).update(text_body='Stored text')
+        call_command('emailqueue_send')
+        self.assertEqual('Stored text', mail.outbox[0].body)
+
+    @override_settings(TEMPLATED_EMAILER_PRECOMPUTE_TEXT_BODY=True)
+    def test_text_body_follows_edited_body(self):
+        eq = EmailQueue.queue_email(template_name='Html Template', send_to='test@domain.com', name='there')
+
+        eq = EmailQueue.objects.get(pk=eq.pk)
+        eq.body = '<p>Edited</p>'
+        eq.save()
+        self.assertEqual('Edited', EmailQueue.objects.get(pk=eq.pk).text_body)
+
+        with override_settings(TEMPLATED_EMAILER_PRECOMPUTE_TEXT_BODY=False):
+            eq = EmailQueue.objects.get(pk=eq.pk)
+            eq.body = '<p>Edited again</p>'
+            eq.save()
+        eq.send(send_immediately=True)
+        self.assertEqual('Edited again', mail.outbox[0].body)
+
+    def test_payload_key_includes_text_body(self):
+        first = EmailQueue.queue_email(template_name='Html Template', send_to='test@domain.com', name='there')
+        second = EmailQueue.queue_email(template_name='Html Template', send_to='test2@domain.com', name='there')
+        self.assertEqual(first.get_payload_key(), second.get_payload_key())
+
+        second.text_body = 'Different text'
+        self.assertNotEqual(first.get_payload_key(), second.get_payload_key())
+
+
+@skipUnless(importlib.util.find_spec('jinja2'), 'jinja2 is not installed')
+class TestJinja2Rendering(TestCase):
+
+    def setUp(self) -> None:
+        EmailTemplate.objects.create(
+            name='Jinja Template',
+            subject='Hi {{ name }}',
+            body='{% for i in items %}{{ loop.index }}:{{ i }} {% endfor %}{{ html }}',
+            render_engine='jinja2',
+        )
+
+    def test_template_override(self):
+        eq = EmailQueue.prepare_email(template_name='Jinja Template', send_to='test@domain.com',
+                                      name='there', items=['a', 'b'], html='<b>')
+        self.assertEqual('Hi there', eq.subject)
+        self.assertEqual('1:a 2:b &lt;b&gt;', eq.body)
+
+    @override_settings(TEMPLATED_EMAILER_RENDER_ENGINE='jinja2')
+    def test_setting_default(self):
+        eq = EmailQueue.prepare_email(subject='{{ 1 + 1 }}', body='body', template_name=None, send_to='test@domain.com')
+        self.assertEqual('2', eq.subject)
+
+    def test_sandboxed(self):
+        from jinja2.exceptions import SecurityError
+
+        with self.assertRaises(SecurityError):
+            rendering.render('{{ x.__class__.__mro__ }}', {'x': 1}, engine='jinja2')
+
+    @override_settings(TEMPLATED_EMAILER_JINJA2_CACHE_SIZE=2)
+    def test_threaded(self):
+        errors = []
+
+        def render(n):
+            try:
+                for i in range(200):
+                    # Every thread renders the same sources, more of them than the cache holds.
+                    self.assertEqual(f'{i % 5}:{n}', rendering.render(f'{i % 5}:{{{{ n }}}}', {'n': n}, engine='jinja2'))
+            except Exception as e:
+                errors.append(e)
+
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            threads = [threading.Thread(target=render, args=(n,)) for n in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            sys.setswitchinterval(interval)
+
+        self.assertEqual([], errors)
+
+
+class TestEmailQueueAdmin(TestCase):
+
+    def setUp(self) -> None:
+        EmailTemplate.objects.create(name='Test Template', subject='Test', body='Test Body!')
+        self.user = get_user_model().objects.create_superuser('admin', 'admin@domain.com', 'password')
+        self.client.force_login(self.user)
+        for i in range(3):
+            EmailQueue.queue_email(template_name='Test Template', send_to=f'test{i}@domain.com', sent_by=self.user)
+
+    def test_changelist(self):
+        response = self.client.get('/admin/django_templated_emailer/emailqueue/', {'sent__exact': '0', 'q': 'test1'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, response.context['cl'].result_count)
+
+    @override_settings(TEMPLATED_EMAILER_ADMIN_SEARCH_MODE='prefix')
+    def test_prefix_search(self):
+        model_admin = EmailQueueAdmin(EmailQueue, None)
+        self.assertEqual(['send_to__startswith', 'subject__startswith'], model_admin.get_search_fields(None))
+
+        response = self.client.get('/admin/django_templated_emailer/emailqueue/', {'q': 'domain'})
+        self.assertEqual(0, response.context['cl'].result_count)
+        response = self.client.get('/admin/django_templated_emailer/emailqueue/', {'q': 'test2'})
+        self.assertEqual(1, response.context['cl'].result_count)
+
+    @override_settings(TEMPLATED_EMAILER_ADMIN_SEARCH_MODE='startswith')
+    def test_invalid_search_mode(self):
+        with self.assertRaises(ImproperlyConfigured):
+            EmailQueueAdmin(EmailQueue, None).get_search_fields(None)
+
+    def test_paginator_counts_without_estimate(self):
+        # SQLite has no row estimate so the real count is used.
+        self.assertEqual(3, EstimatedCountPaginator(EmailQueue.objects.order_by('pk'), 100).count)
+
+    def test_paginator_uses_estimate_for_large_unfiltered_tables(self):
+        with mock.patch('django_templated_emailer.admin.estimate_count', return_value=5000000):
+            self.assertEqual(5000000, EstimatedCountPaginator(EmailQueue.objects.order_by('pk'), 100).count)
+            self.assertEqual(1, EstimatedCountPaginator(EmailQueue.objects.filter(send_to='test1@domain.com').order_by('pk'), 100).count)
+
+
+class TestRequeueAndCancel(TestCase):
+
+    def setUp(self) -> None:
+        EmailTemplate.objects.create(name='Test Template', subject='Test', body='Test Body!')
+        self.user = get_user_model().objects.create_user('admin', 'admin@domain.com', 'password')
+        for i in range(5):
+            EmailQueue.queue_email(template_name='Test Template', send_to=f'test{i}@domain.com', sent=True)
+
+    def test_requeue(self):
+        # MAX(id), then a SELECT and an INSERT per batch of 3 and the final empty SELECT.
+        with self.assertNumQueries(6):
+            self.assertEqual(5, EmailQueue.objects.all().requeue(batch_size=3))
+
+        requeued = EmailQueue.objects.filter(sent=False)
+        self.assertEqual(5, requeued.count())
+        self.assertEqual(
+            sorted(EmailQueue.objects.filter(sent=True).values_list('send_to', flat=True)),
+            sorted(requeued.values_list('send_to', flat=True)),
+        )
+
+    def test_cancel(self):
+        EmailQueue.objects.all().requeue()
+
+        self.assertEqual(5, EmailQueue.objects.all().cancel(user=self.user, batch_size=2))
+        self.assertFalse(EmailQueue.objects.filter(sent=False).exists())
+        self.assertEqual(5, EmailQueue.objects.filter(template_name__startswith='Test Template - Undo by admin@domain.com').count())
+
+    def test_command(self):
+        call_command('emailqueue_requeue', template='Test Template', sent=True, stdout=mock.Mock())
+        self.assertEqual(5, EmailQueue.objects.filter(sent=False).count())
+
+        call_command('emailqueue_requeue', '--cancel', '--unsent', '--user', 'admin', stdout=mock.Mock())
+        self.assertFalse(EmailQueue.objects.filter(sent=False).exists())
+
+    def test_command_requires_a_selector(self):
+        with self.assertRaises(CommandError):
+            call_command('emailqueue_requeue', stdout=mock.Mock())
+        self.assertFalse(EmailQueue.objects.filter(sent=False).exists())
+
+        call_command('emailqueue_requeue', all=True, stdout=mock.Mock())
+        self.assertEqual(5, EmailQueue.objects.filter(sent=False).count())
+
+
+@override_settings(TEMPLATED_EMAILER_LINK_CONTENT_TYPES=True)
+class TestContentTypeLinks(TestCase):
+
+    def setUp(self) -> None:
+        EmailTemplate.objects.create(name='Test Template', subject='Test', body='Test Body!')
+        self.users = [get_user_model().objects.create_user(f'user{i}', f'user{i}@domain.com', 'password') for i in range(3)]
+        for user in self.users[:2]:
+            EmailQueue.queue_email(template_name='Test Template', send_to=user.email, model_one=user, model_two=self.users[2])
+
+    def test_set_model_data(self):
+        email = EmailQueue.objects.get(send_to='user0@domain.com')
+        self.assertEqual(self.users[0], email.model_one_object)
+        self.assertEqual(self.users[2], email.model_two_object)
+        self.assertEqual('User', email.model_one_name)
+
+    def test_search_for(self):
+        self.assertEqual(1, EmailQueue.search_for(model_one=self.users[0]).count())
+        self.assertEqual(2, EmailQueue.search_for(model_two=self.users[2]).count())
+        self.assertEqual(2, EmailQueue.search_for(model_one=self.users[2], search_both=True).count())
+
+        with override_settings(TEMPLATED_EMAILER_LINK_CONTENT_TYPES=False):
+            self.assertEqual(1, EmailQueue.search_for(model_one=self.users[0]).count())
+
+    def test_prefetch_for(self):
+        ContentType.objects.clear_cache()
+
+        # The user ContentType, then the emails.
+        with self.assertNumQueries(2):
+            users = EmailQueue.prefetch_for(self.users)
+            self.assertEqual([1, 1, 0], [len(u.queued_emails) for u in users])
+
+        with override_settings(TEMPLATED_EMAILER_LINK_CONTENT_TYPES=False):
+            users = EmailQueue.prefetch_for(self.users, attr='by_name')
+        self.assertEqual([1, 1, 0], [len(u.by_name) for u in users])
+
+    def test_emails_queued_before_linking_are_found(self):
+        with override_settings(TEMPLATED_EMAILER_LINK_CONTENT_TYPES=False):
+            EmailQueue.queue_email(template_name='Test Template', send_to='old@domain.com', model_one=self.users[0])
+        self.assertIsNone(EmailQueue.objects.get(send_to='old@domain.com').model_one_type)
+
+        self.assertEqual(2, EmailQueue.search_for(model_one=self.users[0]).count())
+        self.assertEqual([2, 1, 0], [len(u.queued_emails) for u in EmailQueue.prefetch_for(self.users)])
+
+    def test_queued_emails_accessor(self):
+        with mock.patch.object(get_user_model(), 'queued_emails', QueuedEmails(), create=True):
+            self.assertEqual(['user0@domain.com'], list(self.users[0].queued_emails.values_list('send_to', flat=True)))
+            self.users[0].delete()
+
+        self.assertTrue(EmailQueue.objects.filter(send_to='user0@domain.com').exists())
+
+
+class TestSinkBackend(TestCase):
+
+    def setUp(self) -> None:
+        EmailTemplate.objects.create(name='Test Template', subject='Test', body='Test Body!')
+        for i in range(5):
+            EmailQueue.queue_email(template_name='Test Template', send_to=f'test{i}@domain.com')
+
+    @override_settings(EMAIL_BACKEND='django_templated_emailer.backends.SinkEmailBackend', TEMPLATED_EMAILER_SINK_BUFFER_SIZE=3)
+    def test_bounded_outbox_and_mbox(self):
+        backends.reset()
+        with tempfile.TemporaryDirectory() as folder, \
+                override_settings(TEMPLATED_EMAILER_SINK_MBOX_PATH=os.path.join(folder, 'sink.mbox')):
+            call_command('emailqueue_send')
+            with open(os.path.join(folder, 'sink.mbox'), 'rb') as f:
+                mbox = f.read()
+            self.assertTrue(mbox.startswith(b'From '))
+            self.assertEqual(4, mbox.count(b'\n\nFrom '))
+
+        self.assertEqual(5, backends.stats['sent'])
+        self.assertEqual(3, len(backends.outbox))
+        self.assertIn(b'To: test4@domain.com', backends.outbox[-1])
+        self.assertFalse(EmailQueue.objects.filter(sent=False).exists())
+
+    @override_settings(EMAIL_BACKEND='django_templated_emailer.backends.SinkEmailBackend', TEMPLATED_EMAILER_SINK_ERROR_RATE=1)
+    def test_error_rate(self):
+        backends.reset()
+        with self.assertLogs('django_templated_emailer.emailqueue_send', 'ERROR'):
+            call_command('emailqueue_send')
+
+        self.assertEqual(5, backends.stats['failed'])
+        self.assertEqual(5, EmailQueue.objects.filter(sent=False).count())
+
+    def test_replay(self):
+        with tempfile.TemporaryDirectory() as folder:
+            export = os.path.join(folder, 'export.json')
+            call_command('dumpdata', 'django_templated_emailer.EmailQueue', output=export)
+            EmailQueue.objects.update(sent=True)
+            waiting = EmailQueue.queue_email(template_name='Test Template', send_to='waiting@domain.com')
+
+            stdout = mock.Mock()
+            call_command('emailqueue_replay', export, repeat=2, send=True, stdout=stdout)
+            report = json.loads(stdout.write.call_args[0][0])
+
+        self.assertEqual(10, report['queued'])
+        self.assertEqual(10, report['sent'])
+        self.assertEqual({'sent': 10}, report['sink'])
+        self.assertEqual(15, EmailQueue.objects.filter(sent=True).count())
+        self.assertFalse(EmailQueue.objects.get(pk=waiting.pk).sent)
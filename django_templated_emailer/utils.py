@@ -1,4 +1,9 @@
+import collections
+import hashlib
 import re
+import threading
+from html.parser import HTMLParser
+
 import requests
 
 
@@ -51,3 +56,97 @@ def download_file(url, filename, write_mode='wb', **kwargs):
     with requests.get(url) as response, open(filename, write_mode, **kwargs) as out_file:
         if response.status_code == 200:
             out_file.write(response.content)
+
+
+def hash_key(*parts):
+    """ Returns a sha256 hex digest of the parts, None and empty strings hash the same.
+
+    >>> hash_key('Template', 'Subject', None) == hash_key('Template', 'Subject', '')
+    True
+    """
+    return hashlib.sha256('\x1f'.join(str(p) if p is not None else '' for p in parts).encode('utf-8')).hexdigest()
+
+
+class HTMLToText(HTMLParser):
+    """ Single pass HTML to plain text, keeps paragraphs, line breaks, list items and link targets. """
+
+    BLOCK_TAGS = {'p', 'div', 'table', 'tr', 'ul', 'ol', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'pre', 'hr', 'section', 'article'}
+    SKIP_TAGS = {'script', 'style', 'head', 'title'}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip = 0
+        self.href = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n\n')
+        elif tag == 'br':
+            self.parts.append('\n')
+        elif tag == 'li':
+            self.parts.append('\n- ')
+        elif tag in ('td', 'th'):
+            self.parts.append(' ')
+        elif tag == 'a':
+            self.href = dict(attrs).get('href')
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip = max(self.skip - 1, 0)
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n\n')
+        elif tag == 'a' and self.href:
+            if self.href.startswith(('http', 'mailto:')):
+                self.parts.append(f' ({self.href})')
+            self.href = None
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.parts.append(re.sub(r'\s+', ' ', data))
+
+    def get_text(self):
+        text = ''.join(self.parts)
+        text = re.sub(r' *\n *', '\n', text)
+        text = re.sub(r'\n{3,}', '\n\n', text)
+        return text.strip()
+
+
+def html_to_text(html):
+    """ Converts an HTML email body to plain text, bodies without any tags are returned unchanged.
+
+    >>> html_to_text('<p>Hello <b>there</b></p><p><a href="https://example.com">Site</a></p>')
+    'Hello there\\n\\nSite (https://example.com)'
+    """
+    if not html or not re.search(r'<[a-zA-Z!/]', html):
+        return html
+    parser = HTMLToText()
+    parser.feed(html)
+    parser.close()
+    return parser.get_text()
+
+
+_text_cache = collections.OrderedDict()
+_text_cache_lock = threading.Lock()
+
+
+def cached_html_to_text(html, maxsize=256):
+    """ html_to_text with the most recent maxsize results kept by body hash. """
+    key = hash_key(html)
+    with _text_cache_lock:
+        if key in _text_cache:
+            _text_cache.move_to_end(key)
+            return _text_cache[key]
+
+    text = html_to_text(html)
+
+    with _text_cache_lock:
+        _text_cache[key] = text
+        while len(_text_cache) > maxsize:
+            _text_cache.popitem(last=False)
+    return text
@@ -0,0 +1,112 @@
+import logging
+import select
+import socket
+
+from django.db import connections, transaction
+
+from .app_settings import app_settings
+
+logger = logging.getLogger('django_templated_emailer')
+
+
+def notify_sender(using='default'):
+    """ Wakes any emailqueue_send --daemon listening on PostgreSQL once the current transaction commits. """
+    channel = app_settings.NOTIFY_CHANNEL
+    connection = connections[using]
+    if not channel or connection.vendor != 'postgresql':
+        return
+
+    def notify():
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_notify(%s, %s)', [channel, ''])
+        except Exception:
+            # The daemon still picks the email up on its next poll.
+            logger.exception('emailqueue_send NOTIFY failed')
+
+    transaction.on_commit(notify, using=using)
+
+
+def get_waker(using='default'):
+    """ Returns a PostgresWaker when the database supports LISTEN/NOTIFY, otherwise a PollingWaker. """
+    if app_settings.NOTIFY_CHANNEL and connections[using].vendor == 'postgresql':
+        return PostgresWaker(app_settings.NOTIFY_CHANNEL, using=using)
+    return PollingWaker()
+
+
+class PollingWaker(object):
+    """ Sleeps for the timeout, or until wake() is called (safe from a signal handler). """
+
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.reader.setblocking(False)
+        self.writer.setblocking(False)
+
+    def fileno_list(self):
+        return [self.reader]
+
+    def wake(self):
+        try:
+            self.writer.send(b'\0')
+        except OSError:
+            pass
+
+    def _drain(self):
+        try:
+            while self.reader.recv(1024):
+                pass
+        except OSError:
+            pass
+
+    def wait(self, timeout):
+        ready, _, _ = select.select(self.fileno_list(), [], [], max(timeout, 0))
+        self._drain()
+        return bool(ready)
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+
+class PostgresWaker(PollingWaker):
+    """ Also wakes when queue_email fires NOTIFY on channel, over a dedicated LISTEN connection. """
+
+    def __init__(self, channel, using='default'):
+        super().__init__()
+        self.channel = channel
+        self.connection = connections[using].copy()
+        self.connection.ensure_connection()
+        self.connection.set_autocommit(True)
+        with self.connection.cursor() as cursor:
+            cursor.execute('LISTEN {}'.format(self.connection.ops.quote_name(channel)))
+
+    def fileno_list(self):
+        return super().fileno_list() + [self.connection.connection]
+
+    def wait(self, timeout):
+        woken = super().wait(timeout)
+        self.drain_notifies()
+        return woken
+
+    def drain_notifies(self):
+        """ Reads and discards pending notifications so the next select doesn't return straight away. """
+        notifies = getattr(self.connection.connection, 'notifies', None)
+
+        if callable(notifies):
+            # psycopg 3 reads pending notifications itself, the timeout argument needs psycopg 3.2.
+            try:
+                for _ in notifies(timeout=0):
+                    pass
+                return
+            except TypeError:
+                pass
+
+        # Running any statement makes the driver read pending notifications, psycopg2 queues them on a list.
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        if isinstance(notifies, list):
+            del notifies[:]
+
+    def close(self):
+        super().close()
+        self.connection.close()
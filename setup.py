@@ -10,5 +10,6 @@ setup(
     license='MIT',
     packages=find_packages(),
     install_requires=["django>=1.11", "requests", "celery"],
+    extras_require={"jinja2": ["jinja2>=3.0"]},
     zip_safe=False
 )